@@ -1,5 +1,6 @@
 # from .dataset import GoProDataset, MixDataset, VideoDataset
 from .data_sampler import DistIterSampler
+from .batch_fetch import BatchIndexSampler, BatchFetchDataset, supports_batch_fetch
 import torch
 import torch.utils.data
 
@@ -22,20 +23,91 @@ def create_dataloader(dataset, args, sampler=None):
     else:
         return torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False, num_workers=1,
                                            pin_memory=True)
+
+def create_batch_dataloader(dataset, args, batch_size, sampler=None):
+    """Loader of whole batches for datasets with get_batch (see dataloader.batch_fetch).
+    Args:
+        batch_size (int): Global batch size, divided over the ranks when args.dist.
+        sampler (Sampler, optional): Per-rank index sampler, e.g. DistIterSampler, random order if None.
+    """
+    pin_memory = torch.cuda.is_available()
+    if args.dist:
+        batch_sampler = BatchIndexSampler(sampler, batch_size // torch.distributed.get_world_size(), drop_last=True)
+        return MultiEpochsDataLoader(BatchFetchDataset(dataset), batch_size=None, sampler=batch_sampler,
+                                     num_workers=args.num_workers, pin_memory=pin_memory)
+    if sampler is None:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    batch_sampler = BatchIndexSampler(sampler, batch_size, drop_last=False)
+    return MultiEpochsDataLoader(BatchFetchDataset(dataset), batch_size=None, sampler=batch_sampler,
+                                 num_workers=args.num_workers, pin_memory=pin_memory)
+
+def create_test_dataloader(dataset, args):
+    """Evaluation loader, one slice per batch. Its workers are started once and serve every evaluation."""
+    return MultiEpochsDataLoader(dataset, batch_size=1, shuffle=False, num_workers=args.num_workers,
+                                 pin_memory=torch.cuda.is_available())
+
+def shutdown_loader(loader):
+    """Stops the worker processes of a MultiEpochsDataLoader or of a DataLoader with persistent workers."""
+    iterator = getattr(loader, 'iterator', None)
+    if iterator is None:
+        iterator = getattr(loader, '_iterator', None)
+    if hasattr(iterator, '_shutdown_workers'):
+        iterator._shutdown_workers()
+
+
+class LoaderPool(object):
+    """ Named data loaders whose worker pools live as long as the pool.
+    Replacing a loader (e.g. the training loader of a new progressive stage) stops the workers of
+    the old one, shutdown() stops all of them.
+    """
+
+    def __init__(self):
+        self.loaders = {}
+
+    def __getitem__(self, name):
+        return self.loaders[name]
+
+    def add(self, name, loader):
+        if name in self.loaders and self.loaders[name] is not loader:
+            shutdown_loader(self.loaders[name])
+        self.loaders[name] = loader
+        return loader
+
+    def shutdown(self):
+        for loader in self.loaders.values():
+            shutdown_loader(loader)
+        self.loaders = {}
+
 class MultiEpochsDataLoader(torch.utils.data.DataLoader):
+    """ DataLoader that keeps a single iterator over a repeating sampler: the workers (or the
+    single-process fetcher with num_workers=0) are created once, in __init__, and already prefetch
+    the first batches. Every epoch has to be iterated to the end.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.epoch = 0
         self._DataLoader__initialized = False
-        self.batch_sampler = _RepeatSampler(self.batch_sampler)
+        if self.batch_sampler is None:
+            # batch_size=None: every item of the sampler is a whole batch
+            self.sampler = _RepeatSampler(self.sampler)
+        else:
+            self.batch_sampler = _RepeatSampler(self.batch_sampler)
         self._DataLoader__initialized = True
         self.iterator = super().__iter__()
 
     def __len__(self):
-        return len(self.batch_sampler.sampler)
+        sampler = self.sampler if self.batch_sampler is None else self.batch_sampler
+        # a pass that already started keeps its length (a resumed DistIterSampler starts with a shorter one)
+        return sampler.lengths.get(self.epoch, len(sampler.sampler))
 
     def __iter__(self):
-        for i in range(len(self)):
+        length = len(self)
+        sampler = self.sampler if self.batch_sampler is None else self.batch_sampler
+        self.epoch += 1
+        for stale in [k for k in sampler.lengths if k < self.epoch - 1]:
+            del sampler.lengths[stale]
+        for i in range(length):
             yield next(self.iterator)
 
 
@@ -47,7 +119,11 @@ class _RepeatSampler(object):
 
     def __init__(self, sampler):
         self.sampler = sampler
+        self.lengths = {}
 
     def __iter__(self):
+        passes = 0
         while True:
-            yield from iter(self.sampler)
\ No newline at end of file
+            self.lengths[passes] = len(self.sampler)
+            yield from iter(self.sampler)
+            passes += 1
\ No newline at end of file
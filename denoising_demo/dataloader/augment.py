@@ -0,0 +1,148 @@
+"""
+Batched data augmentation on the training device.
+
+Every sample of a batch gets its own dihedral transform (flips / rot90), crop origin and
+intensity scale. The transforms are turned into one table of flat source indices per
+sample, so images and labels of the whole batch are augmented by a single ``gather``;
+there is no per-sample Python loop.
+
+``PatchSampler`` (--crop_size / --patches_per_slice) cuts several random crops out of every
+training slice with the same kind of gather, origins are drawn preferably on the foreground.
+"""
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment(object):
+    """
+    Args:
+        crop_size (int): Side of the random crops, 0 keeps the full slices.
+        scale_range (tuple): Per-sample intensity scale, applied to images and labels alike.
+        device (torch.device): Device of the batches and of the random generator.
+        seed (int): Seed of the generator.
+    """
+
+    def __init__(self, crop_size=0, scale_range=(0.9, 1.1), device='cpu', seed=0):
+        self.crop_size = crop_size
+        self.scale_range = scale_range
+        self.device = torch.device(device)
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+        self.tables = {}
+
+    def dihedral_table(self, height, width):
+        """[8][H][W] flat source index of every output pixel for the 8 dihedral transforms
+        (the 4 transforms that keep the shape when the slices are not square)."""
+        key = (height, width)
+        if key not in self.tables:
+            index = torch.arange(height * width, device=self.device).view(height, width)
+            tables = []
+            for flip in (False, True):
+                flipped = index.flip(-1) if flip else index
+                for k in range(4):
+                    if k % 2 == 0 or height == width:
+                        tables.append(torch.rot90(flipped, k, dims=(-2, -1)))
+            self.tables[key] = torch.stack(tables)
+        return self.tables[key]
+
+    def _randint(self, high, size):
+        return torch.randint(0, high, size, generator=self.generator, device=self.device)
+
+    def source_indices(self, batch_size, height, width, crop_size=0):
+        """[B][h][w] flat source indices of a random dihedral transform and crop of every sample."""
+        table = self.dihedral_table(height, width)
+        crop_h = min(crop_size, height) if crop_size else height
+        crop_w = min(crop_size, width) if crop_size else width
+        k = self._randint(len(table), (batch_size,))
+        oy = self._randint(height - crop_h + 1, (batch_size,))
+        ox = self._randint(width - crop_w + 1, (batch_size,))
+        rows = (oy[:, None] + torch.arange(crop_h, device=self.device))[:, :, None]
+        cols = (ox[:, None] + torch.arange(crop_w, device=self.device))[:, None, :]
+        return table[k[:, None, None], rows, cols]
+
+    def gather(self, x, index):
+        """x [B][C][H][W], index [B][h][w] -> [B][C][h][w]."""
+        B, C = x.shape[:2]
+        h, w = index.shape[1:]
+        index = index.view(B, 1, h * w).expand(B, C, h * w)
+        return torch.gather(x.reshape(B, C, -1), 2, index).view(B, C, h, w)
+
+    def __call__(self, images, labels):
+        B, C, H, W = images.shape
+        pair = torch.cat([images, labels], dim=1)
+        pair = self.gather(pair, self.source_indices(B, H, W, self.crop_size))
+        low, high = self.scale_range
+        if low != 1 or high != 1:
+            scale = torch.rand((B, 1, 1, 1), generator=self.generator, device=self.device) * (high - low) + low
+            pair = pair * scale
+        return pair[:, :C], pair[:, C:]
+
+
+class PatchSampler(object):
+    """
+    Args:
+        crop_size (int): Side of the square patches.
+        patches_per_slice (int): Patches cut out of every slice, the batch grows by this factor.
+        foreground (float): Fraction of the slice maximum above which a label pixel is foreground.
+        background_weight (float): Sampling weight of a crop without foreground relative to a full one.
+        device (torch.device): Device of the batches and of the random generator.
+        seed (int): Seed of the generator.
+    """
+
+    def __init__(self, crop_size, patches_per_slice=1, foreground=0.1, background_weight=0.05, device='cpu', seed=0):
+        self.crop_size = crop_size
+        self.patches_per_slice = patches_per_slice
+        self.foreground = foreground
+        self.background_weight = background_weight
+        self.device = torch.device(device)
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+
+    def origins(self, labels):
+        """[B][P] crop origins (oy, ox), drawn on a coarse grid weighted by the foreground of every crop."""
+        B, _, H, W = labels.shape
+        size = self.crop_size
+        stride = max(1, size // 4)
+        peak = labels.amax(dim=(1, 2, 3), keepdim=True)
+        mask = (labels.amax(dim=1, keepdim=True) > self.foreground * peak).float()
+        # foreground fraction of the crop starting at every grid point: [B][gy][gx]
+        fraction = F.avg_pool2d(mask, size, stride)[:, 0]
+        gy, gx = fraction.shape[1:]
+        weights = (fraction + self.background_weight).view(B, -1)
+        cell = torch.multinomial(weights, self.patches_per_slice, replacement=True, generator=self.generator)
+        # jitter inside the grid cell, clamped to the slice
+        jitter = torch.randint(0, stride, (2, B, self.patches_per_slice), generator=self.generator, device=self.device)
+        oy = torch.clamp(cell // gx * stride + jitter[0], max=H - size)
+        ox = torch.clamp(cell % gx * stride + jitter[1], max=W - size)
+        return oy, ox
+
+    def __call__(self, images, labels):
+        B, C, H, W = images.shape
+        size, P = self.crop_size, self.patches_per_slice
+        if size <= 0 or size > min(H, W):
+            return images, labels
+        oy, ox = self.origins(labels)
+        offsets = torch.arange(size, device=self.device)
+        rows = (oy[:, :, None] + offsets)[:, :, :, None]            # [B][P][h][1]
+        cols = (ox[:, :, None] + offsets)[:, :, None, :]            # [B][P][1][w]
+        index = (rows * W + cols).view(B, 1, P * size * size)
+        pair = torch.cat([images, labels], dim=1)
+        Ct = pair.shape[1]
+        patches = torch.gather(pair.reshape(B, Ct, -1), 2, index.expand(B, Ct, P * size * size))
+        patches = patches.view(B, Ct, P, size, size).transpose(1, 2).reshape(B * P, Ct, size, size)
+        return patches[:, :C], patches[:, C:]
+
+
+def create_patches(args):
+    """PatchSampler of --crop_size / --patches_per_slice, None for full-frame training."""
+    if getattr(args, 'crop_size', 0) <= 0:
+        return None
+    seed = getattr(args, 'random_seed', 0) * 1000 + max(getattr(args, 'rank', 0), 0) + 700
+    return PatchSampler(args.crop_size, getattr(args, 'patches_per_slice', 1), device=args.device, seed=seed)
+
+
+def create_augment(args):
+    """BatchAugment configured by --aug_crop / --aug_scale, seeded by --random_seed and the rank."""
+    scale = getattr(args, 'aug_scale', 0.1)
+    seed = getattr(args, 'random_seed', 0) * 1000 + max(getattr(args, 'rank', 0), 0) + 500
+    return BatchAugment(getattr(args, 'aug_crop', 0), (1 - scale, 1 + scale), args.device, seed)
@@ -0,0 +1,110 @@
+"""
+Batch-level fetching for the in-memory datasets.
+
+Datasets with a ``get_batch(indices, alloc)`` method (TrainSet / TestSet) hand out whole
+batches: ``BatchIndexSampler`` yields one index array per batch, ``BatchFetchDataset`` turns
+it into a ``get_batch`` call and the DataLoader runs with ``batch_size=None``, so there is no
+per-sample ``__getitem__`` and no collation. In the main process the batches are gathered
+straight into a ring of reused pinned buffers.
+"""
+import numpy as np
+import torch
+from torch.utils.data import Dataset, ConcatDataset, Sampler, get_worker_info
+
+
+def supports_batch_fetch(dataset):
+    if isinstance(dataset, ConcatDataset):
+        return all(supports_batch_fetch(d) for d in dataset.datasets)
+    return hasattr(dataset, 'get_batch')
+
+
+class BatchIndexSampler(Sampler):
+    """Groups the indices of ``sampler`` into int64 arrays of ``batch_size``."""
+
+    def __init__(self, sampler, batch_size, drop_last=True):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        batch = []
+        for idx in self.sampler:
+            batch.append(idx)
+            if len(batch) == self.batch_size:
+                yield np.array(batch, dtype=np.int64)
+                batch = []
+        if batch and not self.drop_last:
+            yield np.array(batch, dtype=np.int64)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
+def fetch_batch(dataset, indices, alloc):
+    """dataset.get_batch, ConcatDataset batches are fetched per member into slices of one buffer.
+    The samples come back grouped by member dataset, which is irrelevant for shuffled training."""
+    if not isinstance(dataset, ConcatDataset):
+        return dataset.get_batch(indices, alloc)
+    member = np.searchsorted(dataset.cumulative_sizes, indices, side='right')
+    order = np.argsort(member, kind='stable')
+    indices, member = indices[order], member[order]
+    full = {}
+
+    def member_alloc(start, stop):
+        def alloc_slice(key, shape):
+            if key not in full:
+                full[key] = alloc(key, (len(indices),) + tuple(shape[1:]))
+            return full[key][start:stop]
+        return alloc_slice
+
+    starts = np.flatnonzero(np.r_[True, member[1:] != member[:-1]])
+    for start, stop in zip(starts, np.r_[starts[1:], len(indices)]):
+        d = member[start]
+        offset = dataset.cumulative_sizes[d - 1] if d > 0 else 0
+        fetch_batch(dataset.datasets[d], indices[start:stop] - offset, member_alloc(start, stop))
+    return full
+
+
+class BatchFetchDataset(Dataset):
+    """Dataset view whose items are whole batches: ``self[index_array]`` -> dict of batched tensors.
+    Args:
+        dataset: Dataset supporting batch fetching (see supports_batch_fetch).
+        ring (int): Pinned buffers kept per batch shape, a buffer is reused ``ring`` batches later.
+            A consumer copying a batch asynchronously has to finish the copy before fetching
+            the next batches (DevicePrefetcher waits for it).
+    """
+
+    def __init__(self, dataset, ring=3):
+        self.dataset = dataset
+        self.ring = ring
+        self.buffers = {}
+        self.pin = torch.cuda.is_available()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffers'] = {}
+        return state
+
+    def alloc(self, key, shape):
+        if not self.pin or get_worker_info() is not None:
+            # worker batches travel through shared memory, the DataLoader pins them afterwards
+            return torch.empty(shape, dtype=torch.float32)
+        ring = self.buffers.setdefault((key, tuple(shape)), [[], 0])
+        buffers, position = ring
+        if len(buffers) < self.ring:
+            buffers.append(torch.empty(shape, dtype=torch.float32, pin_memory=True))
+        buffer = buffers[position % len(buffers)]
+        ring[1] = position + 1
+        return buffer
+
+    def __getitem__(self, indices):
+        return fetch_batch(self.dataset, np.asarray(indices, dtype=np.int64), self.alloc)
@@ -0,0 +1,126 @@
+"""
+SVD coil compression of multi-coil k-space.
+
+The physical coils are mixed into virtual coils by the leading left singular vectors of the
+calibration region (the k-space centre, where the coil correlation is measured with the most
+signal). With all virtual coils the mixing is unitary and the RSS is unchanged; dropping the
+weakest ones removes their power from every pixel, so the ifft2 work and the k-space memory
+shrink with the coil count at the price of the discarded energy.
+
+Report the RSS error of a setting, from the denoising_demo folder:
+    python -m dataloader.coil_compression --data_root /data0/M4RawV1.5/multicoil_train/ --virtual_coils 2
+"""
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import h5py
+
+# side of the centred calibration block
+CALIBRATION = 32
+
+
+def calibration_region(kspace, size=CALIBRATION):
+    """Centre [..][coils][size][size] block of [..][coils][high][width] k-space (array or h5py dataset)."""
+    high, width = kspace.shape[-2:]
+    h0, w0 = max(0, (high - size) // 2), max(0, (width - size) // 2)
+    return kspace[..., h0:h0 + size, w0:w0 + size]
+
+
+def compression_matrix(kspace, virtual_coils=0, energy=0., size=CALIBRATION):
+    """[virtual][coils] complex64 compression matrix of a volume or slice.
+    Args:
+        virtual_coils (int): Virtual coils kept, 0 to choose them by energy.
+        energy (float): Smallest kept fraction of the calibration energy, used when virtual_coils is 0.
+    Returns:
+        (matrix, retained): retained is the fraction of the calibration energy kept.
+    """
+    calib = np.asarray(calibration_region(kspace, size))
+    coils = calib.shape[-3]
+    x = np.moveaxis(calib, -3, 0).reshape(coils, -1).astype(np.complex128)
+    # the squared singular values of x are the eigenvalues of the coil covariance
+    values, vectors = np.linalg.eigh(x @ x.conj().T)
+    values, vectors = np.clip(values[::-1], 0, None), vectors[:, ::-1]
+    total = values.sum()
+    if virtual_coils > 0:
+        kept = min(virtual_coils, coils)
+    elif energy > 0 and total > 0:
+        kept = min(coils, int(np.searchsorted(np.cumsum(values) / total, energy)) + 1)
+    else:
+        kept = coils
+    retained = float(values[:kept].sum() / total) if total > 0 else 1.
+    return vectors[:, :kept].conj().T.astype(np.complex64), retained
+
+
+def compress(kspace, matrix):
+    """[..][coils][high][width] -> [..][virtual][high][width] complex64."""
+    kspace = np.asarray(kspace, dtype=np.complex64)
+    shape = kspace.shape
+    mixed = np.matmul(matrix, kspace.reshape(shape[:-2] + (-1,)))
+    return mixed.reshape(shape[:-3] + (matrix.shape[0],) + shape[-2:])
+
+
+class CoilCompressedTransform(object):
+    """fastmri data transform (VarNetDataTransform, UnetDataTransform) applied to coil-compressed k-space.
+    The transforms see one slice at a time, so the compression matrix is computed per slice.
+    Args:
+        transform (callable): transform(kspace, mask, target, attrs, fname, slice_num).
+        virtual_coils (int): see compression_matrix, 0 together with energy 0 disables the compression.
+        energy (float): see compression_matrix.
+    """
+
+    def __init__(self, transform, virtual_coils=0, energy=0.):
+        self.transform = transform
+        self.virtual_coils = virtual_coils
+        self.energy = energy
+
+    def __call__(self, kspace, mask, target, attrs, fname, slice_num):
+        if kspace.ndim == 3 and (self.virtual_coils > 0 or self.energy > 0):
+            matrix, _ = compression_matrix(kspace, self.virtual_coils, self.energy)
+            kspace = compress(kspace, matrix)
+        return self.transform(kspace, mask, target, attrs, fname, slice_num)
+
+
+def rss_error(kspace, engine, reference=None):
+    """Relative L2 error of the RSS volume of engine against the RSS of all physical coils.
+    Returns:
+        (error, retained energy of the volume, seconds of engine.rss, seconds of the reference)
+    """
+    from dataloader.recon import ReconEngine
+    if reference is None:
+        reference = ReconEngine(engine.memory_budget, engine.num_threads, engine.device)
+    t0 = time.perf_counter()
+    rss = engine.rss(kspace)
+    t1 = time.perf_counter()
+    full = reference.rss(kspace)
+    t2 = time.perf_counter()
+    _, retained = compression_matrix(kspace, engine.virtual_coils, engine.coil_energy)
+    error = float(np.linalg.norm(rss - full) / max(np.linalg.norm(full), 1e-12))
+    return error, retained, t1 - t0, t2 - t1
+
+
+def main():
+    from dataloader.recon import ReconEngine
+    parser = argparse.ArgumentParser(description='RSS error of coil compression')
+    parser.add_argument('--data_root', default='', type=str, help='folder with M4Raw .h5 files')
+    parser.add_argument('--virtual_coils', default=0, type=int)
+    parser.add_argument('--coil_energy', default=0.99, type=float, help='used when --virtual_coils is 0')
+    parser.add_argument('--max_files', default=20, type=int)
+    args = parser.parse_args()
+
+    engine = ReconEngine(virtual_coils=args.virtual_coils, coil_energy=args.coil_energy)
+    errors = []
+    for path in sorted(glob.glob(os.path.join(args.data_root, '*.h5')))[:args.max_files]:
+        with h5py.File(path, 'r') as hf:
+            kspace = hf['kspace'][()]
+        error, retained, t_compressed, t_full = rss_error(kspace, engine)
+        errors.append(error)
+        print('%s: %d coils, RSS error %.3f%%, energy kept %.3f%%, %.3fs vs %.3fs' %
+              (os.path.basename(path), kspace.shape[1], 100 * error, 100 * retained, t_compressed, t_full))
+    if errors:
+        print('mean RSS error %.3f%%, max %.3f%%' % (100 * np.mean(errors), 100 * np.max(errors)))
+
+
+if __name__ == '__main__':
+    main()
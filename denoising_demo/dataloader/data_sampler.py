@@ -2,12 +2,69 @@
 Modified from torch.utils.data.distributed.DistributedSampler
 Support enlarging the dataset for *iteration-oriented* training, for saving time when restart the
 dataloader after each epoch
+
+The epoch permutation is a seeded Feistel network over the positions (cycle-walked down to
+total_size), evaluated block by block: memory is O(1) in the epoch length, no index list is
+materialized. The sampler position (epoch, offset) can be saved and loaded, a resumed epoch
+continues with the next sample of the interrupted one.
 """
 import math
+import numpy as np
 import torch
 from torch.utils.data.sampler import Sampler
 import torch.distributed as dist
 
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(z):
+    """splitmix64 finalizer, works on python ints and uint64 arrays."""
+    if isinstance(z, np.ndarray):
+        z = z ^ (z >> np.uint64(30))
+        z = z * np.uint64(0xbf58476d1ce4e5b9)
+        z = z ^ (z >> np.uint64(27))
+        z = z * np.uint64(0x94d049bb133111eb)
+        return z ^ (z >> np.uint64(31))
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9 & _MASK64
+    z = (z ^ (z >> 27)) * 0x94d049bb133111eb & _MASK64
+    return z ^ (z >> 31)
+
+
+class FeistelPermutation(object):
+    """Pseudo-random permutation of range(size), evaluated for arrays of positions.
+    Args:
+        size (int): Size of the permuted range.
+        seed (int): Seed, together with epoch it selects the permutation.
+        rounds (int): Feistel rounds.
+    """
+
+    def __init__(self, size, seed=0, epoch=0, rounds=4):
+        self.size = size
+        self.half = max(1, (max(size - 1, 1).bit_length() + 1) // 2)
+        self.mask = np.uint64((1 << self.half) - 1)
+        key = _mix64((seed * 0x9e3779b97f4a7c15 + epoch) & _MASK64)
+        self.keys = []
+        for _ in range(rounds):
+            key = _mix64((key + 0x9e3779b97f4a7c15) & _MASK64)
+            self.keys.append(np.uint64(key))
+
+    def _rounds(self, x):
+        half = np.uint64(self.half)
+        left, right = x >> half, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix64(right + key) & self.mask)
+        return (left << half) | right
+
+    def __call__(self, positions):
+        x = self._rounds(np.asarray(positions, dtype=np.uint64))
+        # cycle walking: the network permutes [0, 4^half), apply it again until inside the range
+        outside = x >= self.size
+        while outside.any():
+            x[outside] = self._rounds(x[outside])
+            outside = x >= self.size
+        return x.astype(np.int64)
+
+
 class DistIterSampler(Sampler):
     """Sampler that restricts data loading to a subset of the dataset.
     It is especially useful in conjunction with
@@ -21,9 +78,11 @@ class DistIterSampler(Sampler):
         num_replicas (optional): Number of processes participating in
             distributed training.
         rank (optional): Rank of the current process within num_replicas.
+        seed (int): Seed of the epoch permutations, identical on all ranks.
+        block (int): Positions permuted per step of the iteration.
     """
 
-    def __init__(self, dataset, num_replicas=None, rank=None, ratio=100):
+    def __init__(self, dataset, num_replicas=None, rank=None, ratio=100, seed=0, block=4096):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -35,24 +94,40 @@ class DistIterSampler(Sampler):
         self.dataset = dataset
         self.num_replicas = num_replicas
         self.rank = rank
+        self.seed = seed
+        self.block = block
         self.epoch = 0
+        self.offset = 0
         self.num_samples = int(math.ceil(len(self.dataset) * ratio / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
 
     def __iter__(self):
-        # deterministically shuffle based on epoch
-        g = torch.Generator()
-        g.manual_seed(self.epoch)
-        indices = torch.randperm(self.total_size, generator=g).tolist()
+        # deterministically shuffle based on seed and epoch, starting at the saved offset
+        permutation = FeistelPermutation(self.total_size, self.seed, self.epoch)
+        offset = self.offset
+        # the next pass is the next epoch
+        self.epoch += 1
+        self.offset = 0
         dsize = len(self.dataset)
-        indices = [v % dsize for v in indices]
-        # subsample
-        indices = indices[self.rank:self.total_size:self.num_replicas]
-        assert len(indices) == self.num_samples
-        return iter(indices)
+        for start in range(offset, self.num_samples, self.block):
+            # subsample: position p of this rank is position rank + p * num_replicas of the epoch
+            positions = np.arange(start, min(start + self.block, self.num_samples), dtype=np.int64)
+            indices = permutation(positions * self.num_replicas + self.rank) % dsize
+            yield from indices.tolist()
 
     def __len__(self):
-        return self.num_samples
+        return self.num_samples - self.offset
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+        self.offset = 0
+
+    def state_dict(self):
+        """Position of the next pass: its epoch and the samples of it this rank skips."""
+        return {'epoch': self.epoch, 'offset': self.offset}
+
+    def load_state_dict(self, state_dict):
+        if not 0 <= state_dict['offset'] <= self.num_samples:
+            raise ValueError('sampler offset %d outside of an epoch of %d samples' % (state_dict['offset'], self.num_samples))
+        self.epoch = state_dict['epoch']
+        self.offset = state_dict['offset']
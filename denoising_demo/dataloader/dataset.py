@@ -13,6 +13,9 @@ from torchvision import transforms
 
 import cv2
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, Counter
 sys.path.append('..')
 from utils import util
 
@@ -21,153 +24,426 @@ import numpy as np
 from matplotlib import pyplot as plt
 import fastmri
 from fastmri.data import transforms as T
+from dataloader.rss_cache import create_cache
+from dataloader.recon import ReconEngine, create_engine
+from dataloader.normalize import normalize
+from dataloader.manifest import load_manifest
+from dataloader import storage, shared
+from dataloader.stream import StreamTrainSet
+from dataloader.packed import PackedFastMRITrainSet, PackedFastMRITestSet
+from dataloader.repetitions import MODALS, RepetitionIndex
+from dataloader.rechunk import open_h5
 
-def normal(x):
-    y = np.zeros_like(x)
-    for i in range(y.shape[0]):
-        x_min = x[i].min()
-        x_max = x[i].max()
-        y[i] = (x[i] - x_min)/(x_max-x_min)
-    return y
-
-def read_h5(file_name):
-    hf = h5py.File(file_name)
-    volume_kspace = hf['kspace'][()]
-    slice_kspace = volume_kspace
-    slice_kspace2 = T.to_tensor(slice_kspace)
-    slice_image = fastmri.ifft2c(slice_kspace2)
-    slice_image_abs = fastmri.complex_abs(slice_image)
-    slice_image_rss = fastmri.rss(slice_image_abs, dim=1)
-    slice_image_rss = np.abs(slice_image_rss.numpy())
-    slice_image_rss = normal(slice_image_rss)
-    return slice_image_rss   # shape: [slice_num][high][width]
-
-class TrainSet(Dataset):
-    def __init__(self, args):
-        if args.modal == 'T1':
-            input_list1 = sorted(glob.glob(os.path.join(args.traindata_root+'/*_T102.h5')))
-            input_list2 = [path.replace('_T102.h5','_T101.h5') for path in input_list1]
-            input_list3 = [path.replace('_T102.h5','_T103.h5') for path in input_list1]
-            all = [input_list1,input_list2,input_list3]
-        elif args.modal == 'T2':
-            input_list1 = sorted(glob.glob(os.path.join(args.traindata_root+'/*_T202.h5')))
-            input_list2 = [path.replace('_T202.h5','_T201.h5') for path in input_list1]
-            input_list3 = [path.replace('_T202.h5','_T203.h5') for path in input_list1]
-            all = [input_list1,input_list2,input_list3]
-        elif args.modal == 'FLAIR':
-            input_list1 = sorted(glob.glob(os.path.join(args.traindata_root+'/*_FLAIR02.h5')))
-            input_list2 = [path.replace('_FLAIR02.h5','_FLAIR01.h5') for path in input_list1]
-            all = [input_list1,input_list2]
-        self.all = all
-        self.images = np.zeros([len(input_list1),len(all), 18, 256, 256])
-        # [Number of samples, Number of modalities, Number of slices, Height, Width]
-        print('TrainSet loading...')
-        for i in range(len(self.all)):
+# slices of every M4Raw volume
+SLICES = 18
+
+def normal(x, inplace=False):
+    # per-slice min-max normalization, vectorized over the slices
+    return normalize(x, 'minmax', inplace)
+
+DEFAULT_ENGINE = ReconEngine()
+
+def stored_rss_valid(hf):
+    # metadata only: reconstruction_rss exists and is [slice_num][high][width] of the k-space
+    if 'reconstruction_rss' not in hf:
+        return False
+    rss_shape = hf['reconstruction_rss'].shape
+    kspace_shape = hf['kspace'].shape
+    return len(rss_shape) == 3 and rss_shape[0] == kspace_shape[0] and rss_shape[1:] == kspace_shape[-2:]
+
+def usable_rss(rss):
+    # finite and not constant on any slice, otherwise the min-max normalization breaks
+    return bool(np.isfinite(rss).all() and (rss.max(axis=(-2,-1)) > rss.min(axis=(-2,-1))).all())
+
+def read_stored_rss(file_name):
+    """Normalized reconstruction_rss of the file, None when it is missing or unusable."""
+    with h5py.File(file_name, 'r') as hf:
+        if not stored_rss_valid(hf):
+            return None
+        # one real image per slice instead of the whole multi-coil k-space
+        slice_image_rss = hf['reconstruction_rss'][()].astype(np.float32)
+    return normal(slice_image_rss, True) if usable_rss(slice_image_rss) else None
+
+def read_h5_many(paths, cache=None, rss_source='kspace', engine=None):
+    """read_h5 of several files, returns [(volume, source)].
+    The files that need a k-space reconstruction are batched through one ReconEngine call.
+    """
+    engine = DEFAULT_ENGINE if engine is None else engine
+    results = [None] * len(paths)
+    pending = []
+    for k, path in enumerate(paths):
+        volume = None if cache is None else cache.load(path)
+        if volume is not None:
+            results[k] = (volume, 'cache')
+            continue
+        volume = read_stored_rss(path) if rss_source == 'auto' else None
+        if volume is not None:
+            results[k] = (volume, 'stored')
+        else:
+            pending.append(k)
+    if pending:
+        for k, volume in zip(pending, engine.rss_files([paths[k] for k in pending])):
+            results[k] = (normal(volume, True), 'kspace')   # shape: [slice_num][high][width]
+    if cache is not None:
+        # memory-mapped float32 volumes, built on the first request only
+        for k, (volume, source) in enumerate(results):
+            if source != 'cache':
+                results[k] = (cache.save(paths[k], volume), source)
+    return results
+
+def read_h5(file_name, cache=None, rss_source='kspace', return_source=False, engine=None):
+    """Normalized RSS volume of an M4Raw file.
+    Args:
+        rss_source: 'kspace' reconstructs from the multi-coil k-space, 'auto' reads the stored
+            reconstruction_rss when it is present and valid and falls back to the k-space otherwise.
+        return_source: also return the path taken, 'cache' | 'stored' | 'kspace'.
+        engine: ReconEngine used for the k-space reconstruction.
+    """
+    volume, source = read_h5_many([file_name], cache, rss_source, engine)[0]
+    return (volume, source) if return_source else volume
+
+def get_file_lists(data_root, modal):
+    """Return one list of H5 paths per repetition, index j of every list is the same subject.
+    The repetitions of a subject are paired through the ISMRMRD headers, see dataloader.repetitions."""
+    if modal not in MODALS:
+        raise ValueError('unknown modal: %s' % modal)
+    return RepetitionIndex.build(data_root, (modal,)).file_lists(modal)
+
+def _init_preprocess_worker():
+    # one FFT thread per process, the pool already occupies every core
+    torch.set_num_threads(1)
+
+def _fill_volume(task):
+    dest_path, shape, j, i, path, cache, rss_source, engine = task
+    dest = np.memmap(dest_path, dtype=np.float32, mode='r+', shape=tuple(shape))
+    dest[j][i], source = read_h5(path, cache, rss_source, True, engine)
+    dest.flush()
+    del dest
+    return source
+
+def report_sources(paths, sources):
+    counts = Counter(sources)
+    print('rss source: ' + ', '.join('%s %d files' % (k, counts[k]) for k in sorted(counts)))
+    if counts['stored']:
+        for path, source in zip(paths, sources):
+            if source == 'kspace':
+                print('  no valid reconstruction_rss, reconstructed from kspace: %s' % path)
+
+def load_volumes(all, shape, cache=None, workers=0, rss_source='kspace', engine=None, batch_files=8):
+    """Run read_h5 on every file of get_file_lists into a [subjects][repetitions][slices][high][width] array.
+    With workers > 1 the files are spread over a process pool that writes straight
+    into a shared memmap (in /dev/shm when available), nothing is sent back by pickling.
+    """
+    paths = [path for i in range(len(all)) for path in all[i]]
+    if workers <= 1:
+        # float32 like read_h5 itself, float64 would only double the memory
+        images = np.zeros(shape, dtype=np.float32)
+        sources = []
+        for i in range(len(all)):
             # i represents the current modality index, e.g., i=0~2 for 'T1' modalities (T101, T102, T103), i=2 for 'FLAIR' modality
-            for j,path in enumerate(all[i]):   
-                # Iterate through each file path in the list 'all[i]', where 'all[i]' corresponds to the file path list for a specific modality,
-                # and 'j' represents the index of the current file.
-                self.images[j][i] = read_h5(path)
-                # 'self.images[j][i]' stores the RSS processing result for the current modality 'i' and file 'j'
-        self.labels = np.mean(self.images,axis=1)
-        # Calculate the mean along the second dimension of 'images', representing the average image for each file across modalities.
-        # The shape of 'labels' eliminates the second dimension (due to averaging over all modalities for each file).
-        # 'self.labels[j][slice_num][height][width]' represents the image at the 'slice_num' slice of file 'j' with dimensions [height][width].
-        print('over load')
-        
-        self.images = self.images.transpose(0,2,1,3,4).reshape(-1,len(all),256,256)
-        # Transpose the original array from order (0,1,2,3,4) to (0,2,1,3,4), swapping the second and third dimensions (modalities and slices).
-        # The resulting array has shape ([len(input_list1), 18, len(all), 256, 256]). Reshape it to (-1, len(all), 256, 256),
-        # combining the first and second dimensions, resulting in a shape of (len(input_list1) * 18, len(all), 256, 256). 
-        
-        self.labels = self.labels.reshape(-1,1,256,256) 
-        # Reshape 'labels' to (-1, 1, 256, 256), combining the second dimension (slice_num) to the first dimension 'j'.
-        # This creates a new array with a shape of (len(input_list1) * 18, 1, 256, 256), where each file's 18 slice images are merged into a large vector.
+            for j0 in range(0, len(all[i]), batch_files):
+                # Iterate through the file paths of 'all[i]' in batches reconstructed together, where 'all[i]' corresponds
+                # to the file path list for a specific modality, and 'j' represents the index of the current file.
+                batch = read_h5_many(all[i][j0:j0+batch_files], cache, rss_source, engine)
+                for j, (volume, source) in enumerate(batch, j0):
+                    images[j][i] = volume
+                    # 'images[j][i]' stores the RSS processing result for the current modality 'i' and file 'j'
+                    sources.append(source)
+        report_sources(paths, sources)
+        return images
+
+    fd, dest_path = tempfile.mkstemp(suffix='.dat', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    os.close(fd)
+    try:
+        images = np.memmap(dest_path, dtype=np.float32, mode='w+', shape=tuple(shape))
+        tasks = [(dest_path, shape, j, i, path, cache, rss_source, engine) for i in range(len(all)) for j, path in enumerate(all[i])]
+        with ProcessPoolExecutor(workers, initializer=_init_preprocess_worker) as pool:
+            sources = list(pool.map(_fill_volume, tasks))
+        report_sources(paths, sources)
+    finally:
+        # the mapping stays valid, the pages are released with the last reference
+        os.remove(dest_path)
+    return images
+
+def build_arrays(file_lists, args, name):
+    """Preprocess the files of every contrast into the storage arrays of TrainSet/TestSet.
+    Args:
+        file_lists (list): get_file_lists of every contrast, each file is read exactly once.
+    The contrasts share one flat array per key, contrast after contrast:
+        images: [slices * repetitions][high][width], slice-major within a contrast.
+        labels: [slices][1][high][width].
+    """
+    print('%s loading...' % name)
+    counts = [len(all[0]) * SLICES for all in file_lists]
+    images = np.empty((sum(count * len(all) for count, all in zip(counts, file_lists)), 256, 256), dtype=np.float32)
+    labels = np.empty((sum(counts), 1, 256, 256), dtype=np.float32)
+    cache, engine = create_cache(args), create_engine(args)
+    image_start = label_start = 0
+    for count, all in zip(counts, file_lists):
+        # [Number of samples, Number of modalities, Number of slices, Height, Width]
+        volumes = load_volumes(all, [len(all[0]), len(all), SLICES, 256, 256], cache,
+                               getattr(args, 'preprocess_workers', 0), getattr(args, 'rss_source', 'kspace'), engine)
+        # The label of a slice is the average over its repetitions.
+        labels[label_start:label_start+count] = np.mean(volumes, axis=1, dtype=np.float64).reshape(-1, 1, 256, 256)
+        # Swap repetitions and slices: the repetitions of one slice are consecutive rows.
+        images[image_start:image_start+count*len(all)] = volumes.transpose(0, 2, 1, 3, 4).reshape(-1, 256, 256)
+        label_start += count
+        image_start += count * len(all)
+        del volumes
+    print('over load')
+
+    storage_dtype = getattr(args, 'storage_dtype', 'float32')
+    images, image_scales = storage.store(images, storage_dtype, '%s images' % name)
+    labels, label_scales = storage.store(labels, storage_dtype, '%s labels' % name)
+    return {'images': images, 'image_scales': image_scales,
+            'labels': labels, 'label_scales': label_scales}
+
+class TrainSet(shared.SharedArrays, Dataset):
+    # --modal ALL is a single dataset over all contrasts
+    multi_contrast = True
+
+    def __init__(self, args, data_root=None, name='TrainSet'):
+        if data_root is None:
+            data_root = args.traindata_root
+        modals = list(MODALS) if args.modal == 'ALL' else [args.modal]
+        if args.modal != 'ALL' and args.modal not in MODALS:
+            raise ValueError('unknown modal: %s' % args.modal)
+        # one header scan pairs the repetitions of every contrast
+        index = RepetitionIndex.build(data_root, modals)
+        self.modals = [modal for modal in modals if modal in index.modals()]
+        if not self.modals:
+            raise ValueError('no %s acquisitions in %s' % (args.modal, data_root))
+        file_lists = [index.file_lists(modal) for modal in self.modals]
+        counts = np.array([len(all[0]) * SLICES for all in file_lists], dtype=np.int64)
+        # sample idx of contrast k is label row idx and image rows image_starts[k] + (idx - label_starts[k]) * repetitions[k] + r
+        self.repetitions = np.array([len(all) for all in file_lists], dtype=np.int64)
+        self.label_starts = np.cumsum(counts) - counts
+        self.image_starts = np.cumsum(counts * self.repetitions) - counts * self.repetitions
+        # with --shared_dataset only the local rank 0 runs build_arrays, the others map its result
+        arrays, self.shared_files = shared.node_shared(args, '%s_%s' % (name, args.modal), sum(sum(file_lists, []), []),
+                                                       lambda: build_arrays(file_lists, args, name))
+        self.images = arrays['images']
+        self.image_scales = arrays.get('image_scales')
+        self.labels = arrays['labels']
+        self.label_scales = arrays.get('label_scales')
         
     def __len__(self):
-        return len(self.images)
+        return len(self.labels)
+
+    def contrast(self, indices):
+        """Position in self.modals of the contrast of every sample index."""
+        return np.searchsorted(self.label_starts, indices, side='right') - 1
+
+    def view(self, modal):
+        """Per-contrast views of the shared storage: images [slices][repetitions][high][width], labels [slices][1][high][width]."""
+        k = self.modals.index(modal)
+        count = (len(self) if k + 1 == len(self.modals) else self.label_starts[k + 1]) - self.label_starts[k]
+        rows = slice(self.image_starts[k], self.image_starts[k] + count * self.repetitions[k])
+        labels = slice(self.label_starts[k], self.label_starts[k] + count)
+        shape = (count, self.repetitions[k]) + self.images.shape[1:]
+        return {'images': self.images[rows].reshape(shape),
+                'image_scales': None if self.image_scales is None else self.image_scales[rows].reshape(shape[:2] + (1, 1)),
+                'labels': self.labels[labels],
+                'label_scales': None if self.label_scales is None else self.label_scales[labels]}
+
+    def choose_repetition(self, count):
+        return np.random.randint(count)
+
+    def choose_repetitions(self, counts):
+        return np.random.randint(counts)
+
+    def get_batch(self, indices, alloc):
+        """Whole batch of samples in two vectorized gathers, see dataloader.batch_fetch.
+        Args:
+            indices (np.ndarray): Sample indices.
+            alloc (callable): alloc(key, shape) returns the float32 tensor the batch is written to.
+        """
+        n, contrast = len(indices), self.contrast(indices)
+        R = self.repetitions[contrast]
+        choisce = self.choose_repetitions(R)
+        images, labels = alloc('images', (n, 1) + self.images.shape[1:]), alloc('labels', (n, 1) + self.labels.shape[2:])
+        rows = self.image_starts[contrast] + (indices - self.label_starts[contrast]) * R + choisce
+        storage.take(self.images, self.image_scales, rows, images.numpy()[:, 0])
+        storage.take(self.labels, self.label_scales, indices, labels.numpy())
+        return {'images': images, 'labels': labels}
 
     def __getitem__(self, idx):
-        images = self.images[idx]
-        labels = self.labels[idx]
-        choisce = np.random.choice([i for i in range(len(self.all))],1)
-        images = images[choisce]
-        sample = {'images':images,
-                  'labels':labels
+        k = self.contrast(idx)
+        row = self.image_starts[k] + (idx - self.label_starts[k]) * self.repetitions[k] + self.choose_repetition(self.repetitions[k])
+        # basic slicing keeps both samples views of the storage arrays
+        sample = {'images':storage.to_tensor(self.images[row:row+1],
+                                            None if self.image_scales is None else self.image_scales[row:row+1]),
+                  'labels':storage.to_tensor(self.labels[idx],
+                                            None if self.label_scales is None else self.label_scales[idx])
                  }
-        for key in sample.keys():
-            sample[key] = sample[key].astype(np.float32)
-            sample[key] = torch.from_numpy(sample[key]).float()
 
         return sample
-class TestSet(Dataset):
+class TestSet(TrainSet):
     def __init__(self, args):
-        if args.modal == 'T1':
-            input_list1 = sorted(glob.glob(os.path.join(args.testdata_root+'/*_T102.h5')))
-            input_list2 = [path.replace('_T102.h5','_T101.h5') for path in input_list1]
-            input_list3 = [path.replace('_T102.h5','_T103.h5') for path in input_list1]
-            all = [input_list1,input_list2,input_list3]
-        elif args.modal == 'T2':
-            input_list1 = sorted(glob.glob(os.path.join(args.testdata_root+'/*_T202.h5')))
-            input_list2 = [path.replace('_T202.h5','_T201.h5') for path in input_list1]
-            input_list3 = [path.replace('_T202.h5','_T203.h5') for path in input_list1]
-            all = [input_list1,input_list2,input_list3]
-        elif args.modal == 'FLAIR':
-            input_list1 = sorted(glob.glob(os.path.join(args.testdata_root+'/*_FLAIR02.h5')))
-            input_list2 = [path.replace('_FLAIR02.h5','_FLAIR01.h5') for path in input_list1]
-            all = [input_list1,input_list2]
-        self.all = all
-        self.images = np.zeros([len(input_list1),len(all), 18, 256, 256])
-        print('TestSet loading...')
-        for i in range(len(self.all)):
-            for j,path in enumerate(all[i]):
-                self.images[j][i] = read_h5(path)
-        self.labels = np.mean(self.images,axis=1)
-        print('over load')
-        
-        self.images = self.images.transpose(0,2,1,3,4).reshape(-1,len(all),256,256)
-        self.labels = self.labels.reshape(-1,1,256,256)
-        
+        super(TestSet, self).__init__(args, args.testdata_root, 'TestSet')
+
+    def choose_repetition(self, count):
+        return 0
+
+    def choose_repetitions(self, counts):
+        return np.zeros(len(counts), dtype=np.int64)
+
+def read_h5_slice(hf, slice_idx, rss_source='kspace', engine=None, matrix=None):
+    """matrix: coil compression matrix of the volume (H5HandleCache.matrix), computed here when
+    the engine compresses and none is given."""
+    if rss_source == 'auto' and stored_rss_valid(hf):
+        slice_image_rss = hf['reconstruction_rss'][slice_idx].astype(np.float32)
+        if usable_rss(slice_image_rss):
+            return normal(slice_image_rss[None], True)[0]
+    engine = DEFAULT_ENGINE if engine is None else engine
+    if matrix is None:
+        # same matrix as the whole-volume reconstruction, not one of the slice
+        matrix = engine.volume_matrix(hf['kspace'])
+    # only the hyperslab of one slice is read from disk: [1][coils][high][width]
+    slice_image_rss = engine.rss(hf['kspace'][slice_idx:slice_idx+1], matrix)
+    return normal(slice_image_rss, True)[0]   # shape: [high][width]
+
+class H5HandleCache(object):
+    """LRU of open read-only h5py files, of the mapped RSS cache entries and of the coil compression
+    matrices of the files.
+    Handles are never shared between processes: they are dropped when the
+    object is pickled for a spawned worker or used after a fork.
+    """
+
+    def __init__(self, max_open=64, cache_mb=4):
+        self.max_open = max_open
+        self.cache_mb = cache_mb
+        self.pid = os.getpid()
+        self.handles = OrderedDict()
+        self.volumes = OrderedDict()
+        self.matrices = OrderedDict()
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # inherited through fork, the parent keeps ownership of these handles
+            self.pid = os.getpid()
+            self.handles = OrderedDict()
+            self.volumes = OrderedDict()
+            self.matrices = OrderedDict()
+
+    def volume(self, path, cache):
+        """cache.load(path) (memmap or None), looked up once per path while it stays in the LRU:
+        no key hashing, stat or np.load per slice."""
+        self._check_pid()
+        if path in self.volumes:
+            self.volumes.move_to_end(path)
+            return self.volumes[path]
+        if len(self.volumes) >= self.max_open:
+            self.volumes.popitem(last=False)
+        volume = self.volumes[path] = cache.load(path)
+        return volume
+
+    def matrix(self, path, engine):
+        """engine.volume_matrix of the k-space of path, computed from the calibration region of the
+        whole volume once per path while it stays in the LRU. None when the engine does not compress."""
+        if not engine.compressing:
+            return None
+        self._check_pid()
+        if path in self.matrices:
+            self.matrices.move_to_end(path)
+            return self.matrices[path]
+        if len(self.matrices) >= self.max_open:
+            self.matrices.popitem(last=False)
+        matrix = self.matrices[path] = engine.volume_matrix(self.get(path)['kspace'])
+        return matrix
+
+    def get(self, path):
+        self._check_pid()
+        hf = self.handles.pop(path, None)
+        if hf is None:
+            if len(self.handles) >= self.max_open:
+                _, oldest = self.handles.popitem(last=False)
+                oldest.close()
+            # chunk cache sized for one slice of k-space
+            hf = open_h5(path, self.cache_mb)
+        self.handles[path] = hf
+        return hf
+
+    def close(self):
+        for hf in self.handles.values():
+            hf.close()
+        self.handles = OrderedDict()
+        self.volumes = OrderedDict()
+        self.matrices = OrderedDict()
+
+    def __getstate__(self):
+        return {'max_open': self.max_open, 'cache_mb': self.cache_mb}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_open'], state.get('cache_mb', 4))
+
+class LazyTrainSet(Dataset):
+    """M4Raw pairs reconstructed slice by slice in __getitem__.
+    Memory stays flat whatever the dataset size, only the k-space of the
+    requested slice is read from each repetition file.
+    """
+
+    def __init__(self, args, data_root=None):
+        if data_root is None:
+            data_root = args.traindata_root
+        self.all = get_file_lists(data_root, args.modal)
+        self.handles = H5HandleCache(getattr(args, 'max_open_files', 64), getattr(args, 'h5_cache_mb', 4))
+        self.cache = create_cache(args)
+        self.rss_source = getattr(args, 'rss_source', 'kspace')
+        self.engine = create_engine(args)
+        num_slices = []
+        for path in self.all[0]:
+            with h5py.File(path, 'r') as hf:
+                num_slices.append(hf['kspace'].shape[0])
+        num_slices = np.array(num_slices, dtype=np.int64)
+        # global index -> (volume, slice)
+        self.volume_index = np.repeat(np.arange(len(num_slices)), num_slices)
+        self.slice_index = np.arange(num_slices.sum()) - np.repeat(np.cumsum(num_slices) - num_slices, num_slices)
+
     def __len__(self):
-        return len(self.images)
+        return len(self.volume_index)
+
+    def read_slice(self, path, slice_idx):
+        if self.cache is not None:
+            volume = self.handles.volume(path, self.cache)
+            if volume is not None:
+                return np.asarray(volume[slice_idx])
+        return read_h5_slice(self.handles.get(path), slice_idx, self.rss_source, self.engine,
+                             self.handles.matrix(path, self.engine))
+
+    def choose_repetition(self):
+        return np.random.randint(len(self.all))
 
     def __getitem__(self, idx):
-        images = self.images[idx]
-        labels = self.labels[idx]
-        choisce = np.random.choice([0],1)
-        images = images[choisce]
-        sample = {'images':images,
-                  'labels':labels
+        volume_idx = self.volume_index[idx]
+        slice_idx = self.slice_index[idx]
+        repetitions = np.stack([self.read_slice(paths[volume_idx], slice_idx) for paths in self.all])
+        choisce = self.choose_repetition()
+        sample = {'images':repetitions[choisce][None],
+                  'labels':repetitions.mean(axis=0)[None]
                  }
         for key in sample.keys():
-            sample[key] = sample[key].astype(np.float32)
-            sample[key] = torch.from_numpy(sample[key]).float()
+            sample[key] = torch.from_numpy(sample[key].astype(np.float32))
 
         return sample
 
+class LazyTestSet(LazyTrainSet):
+    def __init__(self, args):
+        super(LazyTestSet, self).__init__(args, args.testdata_root)
+
+    def choose_repetition(self):
+        return 0
+
 class FastMRITrainSet(Dataset):
+    sigma_range = (8, 15)
+    # returns the clean uint8 slice with --device_noise
+    clean_uint8 = True
+
     def __init__(self, args):
-        p_t2 = glob.glob('/data2/fastmri/png/train/*AXT2*') + glob.glob('/data2/fastmri/png/val/*AXT2*')
-        p_flair = glob.glob('/data2/fastmri/png/train/*AXFLAIR*') + glob.glob('/data2/fastmri/png/val/*AXFLAIR*')
-        p_t1 = glob.glob('/data2/fastmri/png/train/*AXT1_*') + glob.glob('/data2/fastmri/png/val/*AXT1_*')
-        p_t1post = glob.glob('/data2/fastmri/png/train/*AXT1POST*') + glob.glob('/data2/fastmri/png/val/*AXT1POST*')
-        p_t1pre = glob.glob('/data2/fastmri/png/train/*AXT1PRE*') + glob.glob('/data2/fastmri/png/val/*AXT1PRE*')
-
-        # 0.8 / 0.1 / 0.1
-        random.Random(0).shuffle(sorted(p_t2))
-        random.Random(0).shuffle(sorted(p_flair))
-        random.Random(0).shuffle(sorted(p_t1))
-        random.Random(0).shuffle(sorted(p_t1post))
-        random.Random(0).shuffle(sorted(p_t1pre))
-
-        # database = p_t1[:272]+p_t1post[:988] + p_t1pre[:261] + p_t2[:2794] + p_flair[:360]
-        database = p_t1+p_t1post + p_t1pre + p_t2 + p_flair
-        
-        self.paths = []
-        for patient in database:
-            paths = sorted(glob.glob(patient+'/*.png'))
-            for path in paths[:10]:
-                self.paths.append(path)
+        # one pass over the tree (or none with --manifest), the 0.8 / 0.1 / 0.1 split is in dataloader.manifest
+        self.paths = load_manifest(args).split('train')
+        # with --device_noise only the clean uint8 slice is returned, the trainer adds the noise on the device
+        self.device_noise = getattr(args, 'device_noise', '')
         
     def __len__(self):
         return len(self.paths)
@@ -175,6 +451,8 @@ class FastMRITrainSet(Dataset):
     def __getitem__(self, idx):
         HR = cv2.imread(self.paths[idx])
         HR = cv2.resize(HR,(256,256))[:,:,0][:,:,None]
+        if self.device_noise:
+            return {'labels': torch.from_numpy(HR).permute(2, 0, 1).contiguous()}
         
         h, w, _ = HR.shape
         noise = np.random.normal(0, np.random.randint(8,15), (h, w,1))
@@ -192,26 +470,7 @@ class FastMRITrainSet(Dataset):
     
 class FastMRITestSet(Dataset):
     def __init__(self, args):
-        p_t2 = glob.glob('/data2/fastmri/png/train/*AXT2*') + glob.glob('/data2/fastmri/png/val/*AXT2*')
-        p_flair = glob.glob('/data2/fastmri/png/train/*AXFLAIR*') + glob.glob('/data2/fastmri/png/val/*AXFLAIR*')
-        p_t1 = glob.glob('/data2/fastmri/png/train/*AXT1_*') + glob.glob('/data2/fastmri/png/val/*AXT1_*')
-        p_t1post = glob.glob('/data2/fastmri/png/train/*AXT1POST*') + glob.glob('/data2/fastmri/png/val/*AXT1POST*')
-        p_t1pre = glob.glob('/data2/fastmri/png/train/*AXT1PRE*') + glob.glob('/data2/fastmri/png/val/*AXT1PRE*')
-
-        # 0.8 / 0.1 / 0.1
-        random.Random(0).shuffle(sorted(p_t2))
-        random.Random(0).shuffle(sorted(p_flair))
-        random.Random(0).shuffle(sorted(p_t1))
-        random.Random(0).shuffle(sorted(p_t1post))
-        random.Random(0).shuffle(sorted(p_t1pre))
-
-        val = p_t1[272:]+p_t1post[988:] + p_t1pre[261:] + p_t2[2794:] + p_flair[360:]
-        
-        self.paths = []
-        for patient in val:
-            paths = sorted(glob.glob(patient+'/*.png'))
-            for path in paths[:10]:
-                self.paths.append(path)
+        self.paths = load_manifest(args).split('val')
         
     def __len__(self):
         return len(self.paths)
@@ -0,0 +1,189 @@
+"""
+File manifest of the FastMRI PNG tree used by FastMRITrainSet / FastMRITestSet.
+
+The tree (<root>/train and <root>/val, one folder per patient holding its slices as PNG)
+is walked once and stored as flat arrays in a single .npz file: patient folders with their
+mtime and contrast, then every slice with its patient, slice index and size. Datasets open
+from the file without touching the tree, a refresh only lists the patient folders whose
+mtime changed.
+
+Build / refresh from the denoising_demo folder:
+    python -m dataloader.manifest build --fastmri_root /data2/fastmri/png --manifest ./fastmri_manifest.npz
+    python -m dataloader.manifest refresh --manifest ./fastmri_manifest.npz
+"""
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# contrast name -> token of the patient folder name, in the order of the original datasets
+CONTRASTS = (('T1', 'AXT1_'), ('T1POST', 'AXT1POST'), ('T1PRE', 'AXT1PRE'), ('T2', 'AXT2'), ('FLAIR', 'AXFLAIR'))
+# number of training patients of every contrast, the remaining ones are the validation patients
+TRAIN_PATIENTS = {'T1': 272, 'T1POST': 988, 'T1PRE': 261, 'T2': 2794, 'FLAIR': 360}
+
+
+def contrast_mask(name):
+    mask = 0
+    for bit, (_, token) in enumerate(CONTRASTS):
+        if token in name:
+            mask |= 1 << bit
+    return mask
+
+
+def scan_patient(folder):
+    """(mtime_ns, sorted png names, sizes) of one patient folder."""
+    # mtime first, a file added while listing makes the next refresh rescan the folder
+    mtime = os.stat(folder).st_mtime_ns
+    entries = sorted((e.name, e.stat().st_size) for e in os.scandir(folder)
+                     if e.name.endswith('.png') and not e.name.startswith('.'))
+    return mtime, [name for name, _ in entries], [size for _, size in entries]
+
+
+class Manifest(object):
+    """Flat index of the PNG slices, the slices of patient i are names[offsets[i]:offsets[i+1]].
+    Args:
+        roots (list): Scanned folders.
+        dirs (np.ndarray): Patient folders, sorted.
+        mtimes (np.ndarray): int64 mtime_ns of every patient folder when it was listed.
+        contrasts (np.ndarray): uint8 bit mask of the CONTRASTS matched by every patient folder.
+        offsets (np.ndarray): int64 [len(dirs) + 1] start of every patient in the slice arrays.
+        names (np.ndarray): Slice file names (bytes).
+        slices (np.ndarray): int32 index of every slice in its sorted patient folder.
+        sizes (np.ndarray): int64 file sizes.
+    """
+
+    def __init__(self, roots, dirs, mtimes, contrasts, offsets, names, slices, sizes):
+        self.roots = [str(root) for root in roots]
+        self.dirs = dirs
+        self.mtimes = mtimes
+        self.contrasts = contrasts
+        self.offsets = offsets
+        self.names = names
+        self.slices = slices
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def build(cls, roots, workers=16, previous=None):
+        """Walk roots, the patient folders of ``previous`` with an unchanged mtime are not listed again."""
+        folders = []
+        for root in roots:
+            folders += [e.path for e in os.scandir(root) if e.is_dir()]
+        folders = sorted(folders)
+        known = {}
+        if previous is not None:
+            known = dict((str(d), k) for k, d in enumerate(previous.dirs))
+
+        mtimes = np.array([os.stat(folder).st_mtime_ns for folder in folders], dtype=np.int64)
+        changed = [k for k, folder in enumerate(folders)
+                   if folder not in known or previous.mtimes[known[folder]] != mtimes[k]]
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            scanned = dict(zip(changed, pool.map(scan_patient, [folders[k] for k in changed])))
+
+        names, sizes, counts = [], [], []
+        for k, folder in enumerate(folders):
+            if k in scanned:
+                mtimes[k], patient_names, patient_sizes = scanned[k]
+                names.append(np.array([name.encode('utf-8') for name in patient_names], dtype=bytes))
+                sizes.append(np.array(patient_sizes, dtype=np.int64))
+            else:
+                i = known[folder]
+                start, stop = previous.offsets[i], previous.offsets[i + 1]
+                names.append(previous.names[start:stop])
+                sizes.append(previous.sizes[start:stop])
+            counts.append(len(names[-1]))
+        print('Manifest: %d patients, %d listed, %d reused' % (len(folders), len(changed), len(folders) - len(changed)))
+
+        offsets = np.zeros(len(folders) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        slices = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], counts)
+        return cls(list(roots), np.array(folders, dtype=str), mtimes,
+                   np.array([contrast_mask(os.path.basename(f)) for f in folders], dtype=np.uint8), offsets,
+                   np.concatenate(names) if names else np.zeros(0, dtype='S1'), slices.astype(np.int32),
+                   np.concatenate(sizes) if sizes else np.zeros(0, dtype=np.int64))
+
+    def refresh(self, workers=16):
+        return Manifest.build(self.roots, workers, previous=self)
+
+    def save(self, path):
+        tmp_path = '%s.tmp.%d.npz' % (path, os.getpid())
+        np.savez(tmp_path, roots=np.array(self.roots, dtype=str), dirs=self.dirs, mtimes=self.mtimes,
+                 contrasts=self.contrasts, offsets=self.offsets, names=self.names, slices=self.slices,
+                 sizes=self.sizes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(list(f['roots']), f['dirs'], f['mtimes'], f['contrasts'], f['offsets'],
+                       f['names'], f['slices'], f['sizes'])
+
+    def patients(self, contrast):
+        """Sorted indices of the patient folders of a contrast."""
+        bit = [name for name, _ in CONTRASTS].index(contrast)
+        return np.flatnonzero(self.contrasts & (1 << bit))
+
+    def paths(self, patients, max_slices=10):
+        """Paths of the first max_slices slices of every patient, in the given patient order."""
+        paths = []
+        for i in patients:
+            start = self.offsets[i]
+            stop = min(self.offsets[i + 1], start + max_slices)
+            folder = str(self.dirs[i])
+            paths += [os.path.join(folder, name.decode('utf-8')) for name in self.names[start:stop]]
+        return paths
+
+    def split(self, split, max_slices=10):
+        """Slice paths of the 'train' (all patients) or 'val' (the patients after TRAIN_PATIENTS) split."""
+        patients = []
+        for contrast, _ in CONTRASTS:
+            selected = self.patients(contrast)
+            patients += list(selected if split == 'train' else selected[TRAIN_PATIENTS[contrast]:])
+        return self.paths(patients, max_slices)
+
+
+def fastmri_roots(args):
+    root = getattr(args, 'fastmri_root', '/data2/fastmri/png')
+    return [os.path.join(root, 'train'), os.path.join(root, 'val')]
+
+
+def load_manifest(args):
+    """Manifest of --fastmri_root, read from --manifest when it exists and built (and saved) otherwise."""
+    roots = fastmri_roots(args)
+    path = getattr(args, 'manifest', '')
+    workers = getattr(args, 'manifest_workers', 16)
+    if path and os.path.exists(path):
+        manifest = Manifest.load(path)
+        if manifest.roots != roots:
+            manifest = Manifest.build(roots, workers)
+        elif getattr(args, 'refresh_manifest', False):
+            manifest = manifest.refresh(workers)
+        else:
+            return manifest
+    else:
+        manifest = Manifest.build(roots, workers)
+    if path:
+        manifest.save(path)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FastMRI PNG manifest')
+    parser.add_argument('command', choices=['build', 'refresh'])
+    parser.add_argument('--fastmri_root', default='/data2/fastmri/png', type=str)
+    parser.add_argument('--manifest', default='./fastmri_manifest.npz', type=str)
+    parser.add_argument('--manifest_workers', default=16, type=int, help='threads listing patient folders')
+    args = parser.parse_args()
+
+    if args.command == 'build' or not os.path.exists(args.manifest):
+        manifest = Manifest.build(fastmri_roots(args), args.manifest_workers)
+    else:
+        manifest = Manifest.load(args.manifest).refresh(args.manifest_workers)
+    manifest.save(args.manifest)
+    print('%s: %d patients, %d slices' % (args.manifest, len(manifest.dirs), len(manifest)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Batch-level noise synthesis on the training device.
+
+With --device_noise the synthetic-noise training sets (FastMRITrainSet,
+PackedFastMRITrainSet) return only the clean slice as uint8 ``labels``. The trainer moves
+the uint8 batch to the device and ``NoiseSynthesizer`` draws one sigma per sample and the
+noise of the whole batch at once:
+
+    gaussian   clip(x + sigma * n, 0, 255)
+    rician     clip(sqrt((x + sigma * n1)^2 + (sigma * n2)^2), 0, 255), magnitude of complex noise
+    kspace     x is spread over synthetic coil sensitivities, complex Gaussian noise with the coil
+               covariance (--coil_correlation / --coil_covariance) is added in multi-coil k-space
+               and the RSS image is reconstructed, see KSpaceNoiseSimulator
+
+All are computed on the 0-255 scale of the PNG slices and returned divided by 255, like
+the per-sample numpy noise of the datasets.
+"""
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+
+NOISE_TYPES = ('gaussian', 'rician', 'kspace')
+
+
+def coil_covariance(num_coils, correlation=0., path=''):
+    """[C][C] noise covariance, read from a .npy file or (1 - rho) * I + rho on every coil pair."""
+    if path:
+        cov = np.load(path)
+        if cov.shape != (num_coils, num_coils):
+            raise ValueError('%s: expected a %dx%d coil covariance, got %s' % (path, num_coils, num_coils, cov.shape))
+        return torch.from_numpy(cov.astype(np.complex64))
+    cov = (1 - correlation) * torch.eye(num_coils) + correlation * torch.ones(num_coils, num_coils)
+    return cov.to(torch.complex64)
+
+
+def coil_sensitivities(num_coils, height, width):
+    """[C][H][W] smooth Gaussian sensitivities of coils placed on a ring around the field of view,
+    normalized so that their root sum of squares is 1 and the noiseless RSS image equals the input."""
+    y = torch.linspace(-1, 1, height).view(1, height, 1)
+    x = torch.linspace(-1, 1, width).view(1, 1, width)
+    angle = torch.arange(num_coils, dtype=torch.float32) * 2 * math.pi / num_coils
+    cy, cx = (0.8 * torch.sin(angle)).view(-1, 1, 1), (0.8 * torch.cos(angle)).view(-1, 1, 1)
+    sens = torch.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * 0.6 ** 2))
+    return sens / sens.pow(2).sum(dim=0, keepdim=True).sqrt()
+
+
+class KSpaceNoiseSimulator(nn.Module):
+    """Multi-coil k-space noise: magnitude images -> noisy RSS images, batched over slices and coils.
+    Args:
+        covariance (torch.Tensor): [C][C] coil noise covariance, C is the number of coils.
+    """
+
+    def __init__(self, covariance):
+        super(KSpaceNoiseSimulator, self).__init__()
+        self.num_coils = covariance.shape[0]
+        self.register_buffer('noise_chol', torch.linalg.cholesky(covariance.to(torch.complex64)))
+        self.white = bool(torch.equal(covariance.to(torch.complex64), torch.eye(self.num_coils, dtype=torch.complex64)))
+        self.sens_cache = {}
+
+    def sensitivities(self, height, width, device):
+        key = (height, width, str(device))
+        if key not in self.sens_cache:
+            self.sens_cache[key] = coil_sensitivities(self.num_coils, height, width).to(device)
+        return self.sens_cache[key]
+
+    def forward(self, x, sigma, generator=None):
+        """
+        Args:
+            x (torch.Tensor): [B][1][H][W] clean magnitude images.
+            sigma (torch.Tensor): [B][1][1][1] standard deviation of the real and imaginary noise of a coil.
+        Returns:
+            [B][1][H][W] RSS images of the noisy coil images.
+        """
+        B, _, H, W = x.shape
+        coil_images = x * self.sensitivities(H, W, x.device)       # [B][C][H][W]
+        noise = torch.randn((B, self.num_coils, H, W, 2), generator=generator, device=x.device)
+        noise = torch.view_as_complex(noise) * sigma
+        if not self.white:
+            noise = torch.einsum('ij,bjhw->bihw', self.noise_chol, noise)
+        # the orthonormal FFT is linear, the k-space noise reaches the coil images through one ifft2, the
+        # fftshifts of ifft2c are left out since they only permute i.i.d. samples
+        noise = torch.fft.ifft2(noise, norm='ortho')
+        noisy = noise + coil_images
+        return (noisy.real ** 2 + noisy.imag ** 2).sum(dim=1, keepdim=True).sqrt()
+
+
+class NoiseSynthesizer(object):
+    """
+    Args:
+        noise_type (str): 'gaussian' | 'rician' | 'kspace'.
+        sigma_range (tuple): Integer sigmas are drawn from [low, high) on the 0-255 scale.
+        device (torch.device): Device of the batches and of the random generator.
+        seed (int): Seed of the generator, runs with the same seed draw the same noise.
+        covariance (torch.Tensor, optional): [C][C] coil noise covariance of the 'kspace' noise.
+    """
+
+    def __init__(self, noise_type='gaussian', sigma_range=(8, 15), device='cpu', seed=0, covariance=None):
+        if noise_type not in NOISE_TYPES:
+            raise ValueError('unknown noise type: %s' % noise_type)
+        self.noise_type = noise_type
+        self.sigma_range = sigma_range
+        self.device = torch.device(device)
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+        self.simulator = None
+        if noise_type == 'kspace':
+            self.simulator = KSpaceNoiseSimulator(coil_covariance(4) if covariance is None else covariance).to(self.device)
+
+    def sample_sigma(self, batch_size):
+        return torch.randint(self.sigma_range[0], self.sigma_range[1], (batch_size, 1, 1, 1),
+                             generator=self.generator, device=self.device).float()
+
+    def noisy(self, clean):
+        """clean: [B][C][H][W] on the 0-255 scale, returns the noisy batch on the same scale."""
+        sigma = self.sample_sigma(clean.shape[0])
+        if self.simulator is not None:
+            return self.simulator(clean, sigma, self.generator).clamp_(0, 255)
+        noise = torch.randn(clean.shape, generator=self.generator, device=self.device).mul_(sigma)
+        if self.noise_type == 'gaussian':
+            return noise.add_(clean).clamp_(0, 255)
+        imag = torch.randn(clean.shape, generator=self.generator, device=self.device).mul_(sigma)
+        return torch.hypot(noise.add_(clean), imag).clamp_(0, 255)
+
+    def __call__(self, batch_samples):
+        """Replace the uint8 ``labels`` of a device batch by float labels and add the noisy ``images``."""
+        clean = batch_samples['labels'].float()
+        batch_samples['images'] = self.noisy(clean).div_(255.)
+        batch_samples['labels'] = clean.div_(255.)
+        return batch_samples
+
+
+def create_noise(args, sigma_range=(8, 15)):
+    """NoiseSynthesizer configured by --device_noise, None when the datasets add the noise themselves."""
+    noise_type = getattr(args, 'device_noise', '')
+    if not noise_type:
+        return None
+    # every rank draws different noise, a restarted run draws the same noise again
+    seed = getattr(args, 'random_seed', 0) * 1000 + max(getattr(args, 'rank', 0), 0)
+    covariance = coil_covariance(getattr(args, 'num_coils', 4), getattr(args, 'coil_correlation', 0.),
+                                 getattr(args, 'coil_covariance', ''))
+    return NoiseSynthesizer(noise_type, sigma_range, args.device, seed, covariance)
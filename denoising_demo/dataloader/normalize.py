@@ -0,0 +1,74 @@
+"""
+Vectorized per-slice intensity normalization shared by the datasets and the BM3D baseline.
+
+Every entry of the first axis (a slice, or a sample of a batch) is normalized with its own
+statistics, computed over all the remaining axes in one reduction. numpy arrays and torch
+tensors are both accepted and the result has the type of the input.
+
+    minmax       (x - min) / (max - min), the original ``normal``
+    percentile   (x - p_low) / (p_high - p_low), clipped to [0, 1]
+    meanstd      (x - mean) / std
+"""
+import numpy as np
+import torch
+
+NORM_MODES = ('minmax', 'percentile', 'meanstd')
+
+
+def _statistics(x, mode, percentiles):
+    """Per-slice (offset, scale), shaped to broadcast against x."""
+    shape = (x.shape[0],) + (1,) * (x.ndim - 1)
+    if torch.is_tensor(x):
+        flat = x.reshape(x.shape[0], -1)
+        if mode == 'minmax':
+            low, high = torch.aminmax(flat, dim=1)
+        elif mode == 'percentile':
+            q = torch.tensor([p / 100. for p in percentiles], dtype=flat.dtype, device=flat.device)
+            low, high = torch.quantile(flat, q, dim=1)
+        else:
+            low, high = flat.mean(dim=1), flat.std(dim=1, unbiased=False)
+            return low.reshape(shape), high.reshape(shape)
+        return low.reshape(shape), (high - low).reshape(shape)
+
+    flat = np.asarray(x).reshape(x.shape[0], -1)
+    if mode == 'minmax':
+        low, high = flat.min(axis=1), flat.max(axis=1)
+    elif mode == 'percentile':
+        low, high = np.percentile(flat, percentiles, axis=1)
+    else:
+        low, high = flat.mean(axis=1), flat.std(axis=1)
+        return low.reshape(shape).astype(x.dtype), high.reshape(shape).astype(x.dtype)
+    return low.reshape(shape).astype(x.dtype), (high - low).reshape(shape).astype(x.dtype)
+
+
+def normalize(x, mode='minmax', inplace=False, percentiles=(0.5, 99.5)):
+    """Normalize every slice of x [N][...] with its own statistics.
+    Args:
+        x (np.ndarray | torch.Tensor): Floating point volume or batch, slices along the first axis.
+        mode (str): 'minmax' | 'percentile' | 'meanstd'.
+        inplace (bool): Overwrite x instead of allocating the result.
+        percentiles (tuple): Low and high percentiles of the 'percentile' mode.
+    Returns:
+        The normalized array, x itself when inplace. Constant slices become 0.
+    """
+    if mode not in NORM_MODES:
+        raise ValueError('unknown normalization mode: %s' % mode)
+    is_tensor = torch.is_tensor(x)
+    floating = x.is_floating_point() if is_tensor else np.issubdtype(x.dtype, np.floating)
+    if not floating:
+        if inplace:
+            raise ValueError('in-place normalization needs a floating point input, got %s' % x.dtype)
+        x = x.float() if is_tensor else x.astype(np.float32)
+        inplace = True
+    offset, scale = _statistics(x, mode, percentiles)
+    scale[scale == 0] = 1
+    if not inplace:
+        x = x.clone() if is_tensor else np.array(x)
+    x -= offset
+    x /= scale
+    if mode == 'percentile':
+        if is_tensor:
+            x.clamp_(0, 1)
+        else:
+            np.clip(x, 0, 1, out=x)
+    return x
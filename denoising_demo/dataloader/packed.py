@@ -0,0 +1,128 @@
+"""
+Pre-decoded FastMRI slices packed into one uint8 memmap per split.
+
+The converter decodes every slice selected by the FastMRI manifest once (cv2.imread,
+resize to 256x256, first channel, exactly as FastMRITrainSet) and writes
+``<split>.npy`` [N][256][256] uint8 plus ``<split>_index.npz`` with the source path of
+every row. PackedFastMRITrainSet / PackedFastMRITestSet then serve read-only views of the
+memmap, no PNG is decoded while training. With --device_noise the training set returns the
+clean uint8 slice only and the noise is added by the trainer (see dataloader.noise).
+
+Pack from the denoising_demo folder:
+    python -m dataloader.packed --fastmri_root /data2/fastmri/png --manifest ./fastmri_manifest.npz --out_dir ./fastmri_packed --workers 32
+Train on it:
+    python train.py --trainset PackedFastMRITrainSet --testset PackedFastMRITestSet --packed_dir ./fastmri_packed ...
+"""
+import os
+import argparse
+import numpy as np
+import cv2
+import torch
+from torch.utils.data import Dataset
+from concurrent.futures import ThreadPoolExecutor
+from dataloader.manifest import load_manifest
+
+SIZE = 256
+CHUNK = 1024
+
+
+def decode_png(path):
+    HR = cv2.imread(path)
+    return cv2.resize(HR, (SIZE, SIZE))[:, :, 0]
+
+
+def pack_split(manifest, split, out_dir, workers=16):
+    """Decode the slices of a manifest split into <out_dir>/<split>.npy, returns the number of rows."""
+    paths = manifest.split(split)
+    tmp_path = os.path.join(out_dir, '%s.tmp.%d.npy' % (split, os.getpid()))
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths), SIZE, SIZE))
+    # cv2 releases the GIL, threads decode in parallel without copying the slices between processes
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        for start in range(0, len(paths), CHUNK):
+            images[start:start+CHUNK] = np.stack(list(pool.map(decode_png, paths[start:start+CHUNK])))
+            print('%s: %d/%d' % (split, min(start + CHUNK, len(paths)), len(paths)))
+    images.flush()
+    del images
+    np.savez(os.path.join(out_dir, '%s_index.npz' % split), paths=np.array(paths, dtype=str))
+    # the array is published last, a readable <split>.npy always has its index
+    os.replace(tmp_path, os.path.join(out_dir, '%s.npy' % split))
+    return len(paths)
+
+
+class PackedFastMRITrainSet(Dataset):
+    """FastMRITrainSet served from the uint8 memmap written by ``pack_split``."""
+    split = 'train'
+    sigma_range = (8, 15)
+    # returns the clean uint8 slice with --device_noise
+    clean_uint8 = True
+
+    def __init__(self, args):
+        packed_dir = getattr(args, 'packed_dir', './fastmri_packed')
+        self.images_path = os.path.join(packed_dir, '%s.npy' % self.split)
+        if not os.path.exists(self.images_path):
+            raise ValueError('%s does not exist, run python -m dataloader.packed first' % self.images_path)
+        with np.load(os.path.join(packed_dir, '%s_index.npz' % self.split)) as f:
+            self.paths = f['paths']
+        self.images = np.load(self.images_path, mmap_mode='r')
+        self.rng, self.rng_pid = None, None
+        self.device_noise = getattr(args, 'device_noise', '') if self.split == 'train' else ''
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getstate__(self):
+        # workers map the file again instead of receiving a pickled memmap
+        state = self.__dict__.copy()
+        state['images'], state['rng'], state['rng_pid'] = None, None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.images = np.load(self.images_path, mmap_mode='r')
+
+    def _generator(self):
+        # one generator per process, seeded from the per-worker torch seed
+        if self.rng_pid != os.getpid():
+            self.rng, self.rng_pid = torch.Generator().manual_seed(torch.initial_seed()), os.getpid()
+        return self.rng
+
+    def __getitem__(self, idx):
+        if self.device_noise:
+            # uint8 transfer, the trainer adds the noise on the device
+            return {'labels': torch.from_numpy(np.array(self.images[idx][None]))}
+        rng = self._generator()
+        # the only copy of the sample: uint8 memmap row -> float32
+        HR = torch.from_numpy(self.images[idx][None].astype(np.float32))
+        sigma = torch.randint(*self.sigma_range, (1,), generator=rng).item()
+        LR = torch.randn(HR.shape, generator=rng).mul_(sigma).add_(HR).clamp_(0, 255)
+        sample = {'images': LR,
+                  'labels': HR
+                 }
+        for key in sample.keys():
+            sample[key] = sample[key].div_(255.)
+
+        return sample
+
+
+class PackedFastMRITestSet(PackedFastMRITrainSet):
+    split = 'val'
+    sigma_range = (8, 12)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pack the FastMRI PNG slices into uint8 memmaps')
+    parser.add_argument('--fastmri_root', default='/data2/fastmri/png', type=str)
+    parser.add_argument('--manifest', default='', type=str)
+    parser.add_argument('--out_dir', default='./fastmri_packed', type=str)
+    parser.add_argument('--split', default='train,val', type=str, help='comma-separated splits: train | val')
+    parser.add_argument('--workers', default=16, type=int, help='decoding threads')
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    manifest = load_manifest(args)
+    for split in args.split.split(','):
+        n = pack_split(manifest, split, args.out_dir, args.workers)
+        print('%s: %d slices, %.1f MB' % (split, n, n * SIZE * SIZE / 2**20))
+
+
+if __name__ == '__main__':
+    main()
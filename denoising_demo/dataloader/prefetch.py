@@ -0,0 +1,133 @@
+"""
+Background prefetching of training batches onto the device.
+
+A thread pulls batches from the DataLoader, stages tensors that are not pinned yet into a
+ring of reused pinned buffers and issues non-blocking copies on a side CUDA stream. Tensors
+that arrive pinned are copied directly; they may be buffers the loader reuses (the pinned
+ring of BatchFetchDataset), so the thread waits for their copies to finish before it asks the
+loader for the next batch. The training loop only waits when none of the next ``depth``
+batches is ready. Without CUDA the thread still overlaps the DataLoader (collation,
+main-process loading) with compute.
+"""
+import queue
+import threading
+import torch
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class DevicePrefetcher(object):
+    """
+    Args:
+        loader: Iterable of dict batches (a DataLoader).
+        device (torch.device): Training device.
+        depth (int): Batches staged ahead of the training loop.
+        skip_keys (tuple): Keys containing one of these strings stay on the host.
+    """
+
+    def __init__(self, loader, device, depth=2, skip_keys=('name', 'pad_nums')):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(1, depth)
+        self.skip_keys = skip_keys
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        # (key, shape, dtype) -> [pinned buffers, copy events, next slot]
+        self.rings = {}
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _pinned(self, key, tensor):
+        ring = self.rings.setdefault((key, tuple(tensor.shape), tensor.dtype), [[], [], 0])
+        buffers, events, slot = ring
+        # depth batches queued, one in use by the training loop, one being staged
+        if len(buffers) < self.depth + 2:
+            buffers.append(torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True))
+            events.append(None)
+        slot = slot % len(buffers)
+        if events[slot] is not None:
+            # the previous copy out of this buffer has to be finished before it is overwritten
+            events[slot].synchronize()
+        ring[2] = slot + 1
+        buffers[slot].copy_(tensor)
+        return buffers[slot], events, slot
+
+    def _stage(self, batch):
+        """(batch on the device, copy event, True if a pinned tensor of the loader is being copied)."""
+        if not self.cuda:
+            return batch, None, False
+        with torch.cuda.stream(self.stream):
+            pending = []
+            borrowed = False
+            for key, value in batch.items():
+                if not torch.is_tensor(value) or any(s in key for s in self.skip_keys):
+                    continue
+                if value.is_pinned():
+                    batch[key] = value.to(self.device, non_blocking=True)
+                    borrowed = True
+                else:
+                    buffer, events, slot = self._pinned(key, value)
+                    batch[key] = buffer.to(self.device, non_blocking=True)
+                    pending.append((events, slot))
+            event = torch.cuda.Event()
+            event.record(self.stream)
+            for events, slot in pending:
+                events[slot] = event
+        return batch, event, borrowed
+
+    def _put(self, out, item, stop):
+        # give up once the training loop stopped consuming
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _producer(self, out, stop):
+        try:
+            if self.cuda:
+                torch.cuda.set_device(self.device)
+            for batch in self.loader:
+                batch, event, borrowed = self._stage(batch)
+                if not self._put(out, (batch, event), stop):
+                    return
+                if borrowed:
+                    # the loader may overwrite its pinned buffers while producing the next batch
+                    event.synchronize()
+        except Exception as e:
+            self._put(out, _Failure(e), stop)
+            return
+        self._put(out, _END, stop)
+
+    def __iter__(self):
+        out = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._producer, args=(out, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = out.get()
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for value in batch.values():
+                        if torch.is_tensor(value) and value.device.type == 'cuda':
+                            # the memory was allocated on the side stream
+                            value.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
@@ -0,0 +1,152 @@
+"""
+Re-chunking of M4Raw H5 files for slice-wise reading.
+
+``kspace`` [slices][coils][high][width] and ``reconstruction_rss`` [slices][high][width] are
+rewritten with one chunk per slice (``--coils_per_chunk`` splits a slice into coil groups),
+optionally compressed losslessly with lzf, gzip or blosc. read_h5_slice / LazyTrainSet then
+read a slice with one chunk read instead of decoding the chunks of the whole volume. blosc
+needs the optional hdf5plugin package, for writing and for reading the converted files.
+
+Convert a split and compare the random-slice read latency, from the denoising_demo folder:
+    python -m dataloader.rechunk convert --src_root /data0/M4RawV1.5/multicoil_train/ --dst_root /data1/M4Raw_sliced/multicoil_train/ --compression lzf --workers 8
+    python -m dataloader.rechunk bench --data_root /data0/M4RawV1.5/multicoil_train/ --data_root /data1/M4Raw_sliced/multicoil_train/
+"""
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import h5py
+
+try:
+    # registers the blosc filter with HDF5
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+COMPRESSIONS = ('none', 'lzf', 'gzip', 'blosc')
+
+
+def compression_options(compression='none', level=4):
+    """create_dataset keyword arguments of a lossless compression."""
+    if compression == 'none':
+        return {}
+    if compression == 'lzf':
+        return {'compression': 'lzf'}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': level}
+    if compression == 'blosc':
+        if hdf5plugin is None:
+            raise ValueError('blosc compression needs the hdf5plugin package')
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError('unknown compression: %s' % compression)
+
+
+def slice_chunks(shape, coils_per_chunk=0):
+    """One chunk per slice: [1][coil group][high][width] for k-space, [1][high][width] for images."""
+    if len(shape) == 4:
+        coils = shape[1] if coils_per_chunk <= 0 else min(coils_per_chunk, shape[1])
+        return (1, coils) + tuple(shape[2:])
+    if len(shape) == 3:
+        return (1,) + tuple(shape[1:])
+    return None
+
+
+def open_h5(path, cache_mb=4):
+    """Read-only h5py.File with a chunk cache of cache_mb MB per dataset (h5py default: 1 MB).
+    A slice of 4-coil 256x256 k-space is 2 MB, with the default cache it is never cached."""
+    return h5py.File(path, 'r', rdcc_nbytes=int(cache_mb * 2**20), rdcc_nslots=10007)
+
+
+def describe(path):
+    """'shape chunks compression' of the k-space of a file."""
+    with h5py.File(path, 'r') as hf:
+        kspace = hf['kspace']
+        return 'kspace %s chunks %s compression %s' % (kspace.shape, kspace.chunks, kspace.compression or 'none')
+
+
+def rechunk_file(src, dst, coils_per_chunk=0, compression='none', level=4):
+    """Copy src to dst with slice chunks, attributes and the other datasets are copied unchanged."""
+    options = compression_options(compression, level)
+    tmp = dst + '.tmp'
+    with h5py.File(src, 'r') as fin, h5py.File(tmp, 'w') as fout:
+        fout.attrs.update(fin.attrs)
+        for name, item in fin.items():
+            chunks = slice_chunks(item.shape, coils_per_chunk) if isinstance(item, h5py.Dataset) else None
+            if chunks is None:
+                fin.copy(item, fout, name)
+                continue
+            out = fout.create_dataset(name, shape=item.shape, dtype=item.dtype, chunks=chunks, **options)
+            # one volume, read in one go whatever the source chunking
+            out[...] = item[()]
+            out.attrs.update(item.attrs)
+    os.replace(tmp, dst)
+    return dst
+
+
+def _convert(task):
+    src, dst, coils_per_chunk, compression, level = task
+    rechunk_file(src, dst, coils_per_chunk, compression, level)
+    return '%s -> %s (%.1f MB -> %.1f MB)' % (src, dst, os.path.getsize(src) / 2**20, os.path.getsize(dst) / 2**20)
+
+
+def benchmark(paths, samples=200, cache_mb=4, seed=0):
+    """Latency of reading the k-space of random single slices, handles kept open like LazyTrainSet.
+    Returns:
+        (median, p95) in milliseconds.
+    """
+    rng = np.random.default_rng(seed)
+    files = [open_h5(path, cache_mb) for path in paths]
+    try:
+        times = []
+        for _ in range(samples):
+            kspace = files[rng.integers(len(files))]['kspace']
+            s = rng.integers(kspace.shape[0])
+            t0 = time.perf_counter()
+            kspace[s:s+1]
+            times.append(time.perf_counter() - t0)
+    finally:
+        for hf in files:
+            hf.close()
+    times = np.array(times) * 1000
+    return float(np.median(times)), float(np.percentile(times, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='M4Raw H5 re-chunking')
+    parser.add_argument('command', choices=['convert', 'bench'])
+    parser.add_argument('--src_root', default='', type=str, help='convert: folder with M4Raw .h5 files')
+    parser.add_argument('--dst_root', default='', type=str, help='convert: output folder, may equal src_root')
+    parser.add_argument('--coils_per_chunk', default=0, type=int, help='coils per k-space chunk, 0 for all coils of a slice')
+    parser.add_argument('--compression', default='none', type=str, help=' | '.join(COMPRESSIONS))
+    parser.add_argument('--level', default=4, type=int, help='gzip / blosc compression level')
+    parser.add_argument('--workers', default=0, type=int, help='processes used by convert, 0 for serial')
+    parser.add_argument('--data_root', default=[], type=str, action='append',
+                        help='bench: folder with .h5 files, may be given several times')
+    parser.add_argument('--samples', default=200, type=int, help='bench: random slices read per folder')
+    parser.add_argument('--cache_mb', default=4, type=float, help='bench: chunk cache per dataset')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        os.makedirs(args.dst_root, exist_ok=True)
+        paths = sorted(glob.glob(os.path.join(args.src_root, '*.h5')))
+        tasks = [(path, os.path.join(args.dst_root, os.path.basename(path)), args.coils_per_chunk,
+                  args.compression, args.level) for path in paths]
+        if args.workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(args.workers) as pool:
+                results = list(pool.map(_convert, tasks))
+        else:
+            results = map(_convert, tasks)
+        for i, result in enumerate(results):
+            print('[%d/%d] %s' % (i + 1, len(tasks), result))
+    else:
+        # reads go through the page cache, drop it before the run for cold-disk numbers
+        for data_root in args.data_root:
+            paths = sorted(glob.glob(os.path.join(data_root, '*.h5')))
+            median, p95 = benchmark(paths, args.samples, args.cache_mb)
+            print('%s: %s, random slice read median %.2f ms, p95 %.2f ms' % (data_root, describe(paths[0]), median, p95))
+
+
+if __name__ == '__main__':
+    main()
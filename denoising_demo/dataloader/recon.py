@@ -0,0 +1,141 @@
+"""
+Batched, chunked RSS reconstruction of multi-coil k-space.
+
+Same result as ``fastmri.ifft2c`` + ``fastmri.complex_abs`` + ``fastmri.rss`` on the
+whole volume, but computed with native complex64 ``torch.fft`` on chunks of slices
+that fit a memory budget. Several small volumes are packed into one chunk so the
+FFT calls stay large, and the chunk is read from H5 only when it is processed.
+
+    engine = ReconEngine(memory_budget=1024, num_threads=8)
+    rss = engine.rss(hf['kspace'])                         # [slices][high][width]
+    volumes = engine.rss_files(paths)                      # one volume per path
+
+With ``virtual_coils`` / ``coil_energy`` every volume is coil-compressed first (see
+dataloader.coil_compression), the FFTs then run on the virtual coils only.
+"""
+import h5py
+import numpy as np
+import torch
+from dataloader.coil_compression import compression_matrix, compress
+
+# complex64 input, its shifted copy and the FFT output live at the same time
+BYTES_PER_VALUE = 8 * 3
+
+
+class ReconEngine(object):
+    """
+    Args:
+        memory_budget (int): MB of working memory allowed for one chunk.
+        num_threads (int): torch intra-op threads used for the FFTs, 0 keeps the current setting.
+        device (str): 'cpu' or a cuda device, results are always returned as numpy arrays.
+        virtual_coils (int): Coil compression of every volume to this many virtual coils, 0 disables it.
+        coil_energy (float): With virtual_coils 0, compress to the fewest virtual coils keeping this
+            fraction of the calibration energy, 0 disables it.
+    """
+
+    def __init__(self, memory_budget=1024, num_threads=0, device='cpu', virtual_coils=0, coil_energy=0.):
+        self.memory_budget = memory_budget
+        self.num_threads = num_threads
+        self.device = torch.device(device)
+        self.virtual_coils = virtual_coils
+        self.coil_energy = coil_energy
+
+    @property
+    def compressing(self):
+        return self.virtual_coils > 0 or self.coil_energy > 0
+
+    def slices_per_chunk(self, slice_shape, virtual_coils=None):
+        # slice_shape: [coils][high][width]
+        slice_bytes = int(np.prod(slice_shape)) * BYTES_PER_VALUE
+        if virtual_coils is not None:
+            # the physical k-space as read plus the FFT working set of the virtual coils
+            slice_bytes = int(np.prod(slice_shape[1:])) * 8 * (slice_shape[0] + 3 * virtual_coils)
+        return max(1, int(self.memory_budget * 2**20 // slice_bytes))
+
+    def _rss(self, kspace):
+        """[n][coils][high][width] complex numpy -> [n][high][width] float32 torch on the device."""
+        x = torch.from_numpy(np.ascontiguousarray(kspace, dtype=np.complex64)).to(self.device)
+        x = torch.fft.ifftshift(x, dim=(-2, -1))
+        x = torch.fft.ifft2(x, dim=(-2, -1), norm='ortho')
+        x = torch.fft.fftshift(x, dim=(-2, -1))
+        return (x.real ** 2 + x.imag ** 2).sum(dim=1).sqrt()
+
+    def _run(self, fn, *args):
+        if self.num_threads <= 0:
+            return fn(*args)
+        previous = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            return fn(*args)
+        finally:
+            torch.set_num_threads(previous)
+
+    def rss(self, kspace, matrix=None):
+        """RSS volume of one [slices][coils][high][width] k-space (numpy array or h5py dataset).
+        matrix: compression matrix to use instead of the one of kspace (e.g. of the whole volume
+        when kspace holds a single slice)."""
+        return self.rss_volumes([kspace], None if matrix is None else [matrix])[0]
+
+    def rss_volumes(self, kspaces, matrices=None):
+        return self._run(self._rss_volumes, kspaces, matrices)
+
+    def volume_matrix(self, kspace):
+        """Compression matrix of a volume from its calibration region, None without compression."""
+        if not self.compressing:
+            return None
+        return compression_matrix(kspace, self.virtual_coils, self.coil_energy)[0]
+
+    def _rss_volumes(self, kspaces, matrices=None):
+        outputs = [np.empty((k.shape[0],) + tuple(k.shape[-2:]), dtype=np.float32) for k in kspaces]
+        if matrices is None:
+            # per-volume compression matrices, from the calibration region only
+            matrices = [self.volume_matrix(k) for k in kspaces]
+        # volumes with the same slice geometry (and virtual coil count) share chunks
+        groups = {}
+        for v, kspace in enumerate(kspaces):
+            virtual = None if matrices[v] is None else len(matrices[v])
+            groups.setdefault((tuple(kspace.shape[1:]), virtual), []).append(v)
+        for (slice_shape, virtual), members in groups.items():
+            chunk_slices = self.slices_per_chunk(slice_shape, virtual)
+            pending, pending_slices = [], 0
+            for v in members:
+                for start in range(0, kspaces[v].shape[0], chunk_slices):
+                    stop = min(start + chunk_slices, kspaces[v].shape[0])
+                    if pending_slices + stop - start > chunk_slices:
+                        self._flush(kspaces, outputs, pending, matrices)
+                        pending, pending_slices = [], 0
+                    pending.append((v, start, stop))
+                    pending_slices += stop - start
+            if pending:
+                self._flush(kspaces, outputs, pending, matrices)
+        return outputs
+
+    def _read(self, kspace, start, stop, matrix):
+        # hyperslab reads only, h5py datasets are never loaded as a whole
+        if matrix is None:
+            return kspace[start:stop]
+        # compressed on the host, only the virtual coils are transferred and transformed
+        return compress(kspace[start:stop], matrix)
+
+    def _flush(self, kspaces, outputs, pending, matrices):
+        batch = np.concatenate([self._read(kspaces[v], start, stop, matrices[v]) for v, start, stop in pending], axis=0)
+        rss = self._rss(batch).cpu().numpy()
+        offset = 0
+        for v, start, stop in pending:
+            outputs[v][start:stop] = rss[offset:offset + stop - start]
+            offset += stop - start
+
+    def rss_files(self, paths, key='kspace'):
+        """RSS volumes of several H5 files, reconstructed in shared chunks."""
+        files = [h5py.File(path, 'r') for path in paths]
+        try:
+            return self.rss_volumes([hf[key] for hf in files])
+        finally:
+            for hf in files:
+                hf.close()
+
+
+def create_engine(args):
+    return ReconEngine(getattr(args, 'recon_memory', 1024), getattr(args, 'recon_threads', 0),
+                       getattr(args, 'recon_device', 'cpu'), getattr(args, 'virtual_coils', 0),
+                       getattr(args, 'coil_energy', 0.))
@@ -0,0 +1,167 @@
+"""
+Multi-contrast index of the M4Raw files, built from the ISMRMRD headers.
+
+Every file lists the other repetitions of its acquisition in
+``repetitionInformation/repetitionLabel/MeasurementID`` (see M4Raw_tutorial.ipynb), so the files
+are grouped by acquisition instead of by file name substitution. As in the tutorial, which opens
+``MeasurementID + '.h5'``, a file is identified by its file name stem; the ``measurementID`` of
+``measurementInformation`` names the sequence (``2022061003_FSE01``), not the file. The contrast
+and the repetition number come from the ID (``2022061003_T201`` is repetition 1 of T2).
+Repetitions are ordered like the original file lists: repetition 2 first (the test inputs), then
+the others.
+
+Check the parsing against the header printed in M4Raw_tutorial.ipynb and list the index of a
+split, from the denoising_demo folder:
+    python -m dataloader.repetitions --data_root /data0/M4RawV1.5/multicoil_train/
+"""
+import os
+import re
+import glob
+import argparse
+import xml.etree.ElementTree as ET
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import h5py
+
+MODALS = ('T1', 'T2', 'FLAIR')
+REFERENCE_REPETITION = 2
+MEASUREMENT_ID = re.compile(r'_(T1|T2|FLAIR)(\d+)$')
+
+# repetitionInformation of the header printed in M4Raw_tutorial.ipynb, with its measurementInformation
+TUTORIAL_HEADER = b"""<ns0:ismrmrdHeader xmlns:ns0="http://www.ismrm.org/ISMRMRD">
+   <ns0:measurementInformation>
+      <ns0:measurementID>2022061003_FSE01</ns0:measurementID>
+      <ns0:protocolName>FSE(Sat) 5mmT--V</ns0:protocolName>
+   </ns0:measurementInformation>
+   <ns0:repetitionInformation>
+      <ns0:RepetitionGroupID>2022061003_T201</ns0:RepetitionGroupID>
+      <ns0:OtherRepetitions>2</ns0:OtherRepetitions>
+      <ns0:repetitionLabel>
+         <ns0:repetitionID>2</ns0:repetitionID>
+         <ns0:MeasurementID>2022061003_T202</ns0:MeasurementID>
+      </ns0:repetitionLabel>
+      <ns0:repetitionLabel>
+         <ns0:repetitionID>3</ns0:repetitionID>
+         <ns0:MeasurementID>2022061003_T203</ns0:MeasurementID>
+      </ns0:repetitionLabel>
+   </ns0:repetitionInformation>
+</ns0:ismrmrdHeader>"""
+
+
+def _local_name(tag):
+    # '{http://www.ismrm.org/ISMRMRD}MeasurementID' -> 'MeasurementID', whatever the prefix of the file
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_header(header):
+    """(RepetitionGroupID, [MeasurementID of the other repetitions]) of an ismrmrd_header,
+    the group ID is None when the header has no repetitionInformation."""
+    if isinstance(header, str):
+        header = header.encode('utf-8')
+    group, others = None, []
+    for element in ET.fromstring(header).iter():
+        name = _local_name(element.tag)
+        if name == 'RepetitionGroupID' and group is None:
+            group = element.text.strip()
+        elif name == 'MeasurementID':
+            others.append(element.text.strip())
+    return group, others
+
+
+def check_tutorial_header():
+    """parse_header of the header printed in M4Raw_tutorial.ipynb finds the two other T2 repetitions."""
+    group, others = parse_header(TUTORIAL_HEADER)
+    expected = ('2022061003_T201', ['2022061003_T202', '2022061003_T203'])
+    if (group, others) != expected:
+        raise AssertionError('parse_header of the tutorial header: %s, expected %s' % ((group, others), expected))
+    if [MEASUREMENT_ID.search(i).groups() for i in others] != [('T2', '02'), ('T2', '03')]:
+        raise AssertionError('MEASUREMENT_ID does not match the tutorial repetition IDs')
+
+
+def read_repetitions(path):
+    """(file ID, [IDs of the other repetitions]) of an M4Raw file, the file ID is the file name stem
+    (the other repetitions are stored as MeasurementID + '.h5')."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    with h5py.File(path, 'r') as hf:
+        if 'ismrmrd_header' not in hf:
+            return stem, []
+        _, others = parse_header(hf['ismrmrd_header'][()])
+    return stem, [i for i in others if i != stem]
+
+
+def repetition_order(measurement_id):
+    """Sort key of the repetitions of one acquisition: the reference repetition first."""
+    number = int(MEASUREMENT_ID.search(measurement_id).group(2))
+    return (number != REFERENCE_REPETITION, number)
+
+
+class RepetitionIndex(object):
+    """
+    Args:
+        acquisitions (dict): modal -> list of acquisitions, every acquisition is the list of
+            paths of its repetitions in repetition_order.
+    """
+
+    def __init__(self, acquisitions):
+        self.acquisitions = acquisitions
+
+    @classmethod
+    def build(cls, data_root, modals=MODALS, workers=8):
+        paths = sorted(glob.glob(os.path.join(data_root, '*.h5')))
+        with ThreadPoolExecutor(workers) as pool:
+            headers = list(pool.map(read_repetitions, paths))
+        by_id = dict((own, path) for path, (own, _) in zip(paths, headers))
+        groups = {}
+        for own, others in headers:
+            match = MEASUREMENT_ID.search(own)
+            if match is None or match.group(1) not in modals:
+                continue
+            # repetitions of the same contrast only, IDs the pattern does not know are ignored
+            others = [i for i in others if MEASUREMENT_ID.search(i) and MEASUREMENT_ID.search(i).group(1) == match.group(1)]
+            groups[tuple(sorted(set([own] + others), key=repetition_order))] = match.group(1)
+
+        acquisitions = dict((modal, []) for modal in modals)
+        incomplete = 0
+        for ids, modal in groups.items():
+            if all(i in by_id for i in ids):
+                acquisitions[modal].append([by_id[i] for i in ids])
+            else:
+                incomplete += 1
+        skipped = incomplete
+        for modal in modals:
+            # all acquisitions of a contrast are stacked, they need the same number of repetitions
+            counts = Counter(len(a) for a in acquisitions[modal])
+            if counts:
+                repetitions = counts.most_common(1)[0][0]
+                skipped += len(acquisitions[modal]) - counts[repetitions]
+                acquisitions[modal] = sorted(a for a in acquisitions[modal] if len(a) == repetitions)
+        if skipped:
+            print('%s: skipped %d acquisitions with missing or extra repetitions' % (data_root, skipped))
+        return cls(acquisitions)
+
+    def modals(self):
+        return [modal for modal in MODALS if self.acquisitions.get(modal)]
+
+    def file_lists(self, modal):
+        """One list of paths per repetition, index j of every list is the same acquisition."""
+        if modal not in self.acquisitions:
+            raise ValueError('unknown modal: %s' % modal)
+        return [list(paths) for paths in zip(*self.acquisitions[modal])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='M4Raw repetition index')
+    parser.add_argument('--data_root', default='', type=str, help='folder with M4Raw .h5 files, empty to only check the parsing')
+    args = parser.parse_args()
+
+    check_tutorial_header()
+    print('tutorial header: ok')
+    if args.data_root:
+        index = RepetitionIndex.build(args.data_root)
+        for modal in MODALS:
+            acquisitions = index.acquisitions.get(modal, [])
+            print('%s: %d acquisitions of %d repetitions' % (modal, len(acquisitions), len(acquisitions[0]) if acquisitions else 0))
+
+
+if __name__ == '__main__':
+    main()
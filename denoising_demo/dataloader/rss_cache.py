@@ -0,0 +1,183 @@
+"""
+Persistent on-disk cache for the normalized RSS volumes produced by ``read_h5``.
+
+Every entry is a float32 ``.npy`` file that is opened memory-mapped, keyed by the
+source file path, its mtime/size and the preprocessing version, so a changed H5
+file or a change of the preprocessing pipeline never serves stale data.
+
+Pre-warm / maintain the cache from the denoising_demo folder:
+    python -m dataloader.rss_cache warm --data_root /data0/M4RawV1.5/multicoil_train/ --cache_dir ./rss_cache --workers 32
+    python -m dataloader.rss_cache prune --cache_dir ./rss_cache
+    python -m dataloader.rss_cache clear --cache_dir ./rss_cache
+"""
+import os
+import glob
+import json
+import hashlib
+import argparse
+import numpy as np
+
+# bump whenever read_h5 produces different numbers for the same file
+PREPROCESS_VERSION = 3
+
+
+class RSSCache(object):
+    """Content-addressed store of preprocessed RSS volumes.
+    Args:
+        cache_dir (str): Folder holding the ``<key>.npy`` volumes and their
+            ``<key>.json`` descriptions.
+        tag (str, optional): Extra preprocessing options that change the
+            output of ``read_h5`` and therefore have to be part of the key.
+    """
+
+    def __init__(self, cache_dir, tag=''):
+        self.cache_dir = cache_dir
+        self.tag = tag
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _source_info(self, file_name):
+        st = os.stat(file_name)
+        return {'source': os.path.abspath(file_name),
+                'mtime_ns': st.st_mtime_ns,
+                'size': st.st_size,
+                'version': PREPROCESS_VERSION,
+                'tag': self.tag}
+
+    def key(self, file_name):
+        info = json.dumps(self._source_info(file_name), sort_keys=True)
+        return hashlib.sha1(info.encode('utf-8')).hexdigest()
+
+    def path(self, file_name):
+        return os.path.join(self.cache_dir, self.key(file_name) + '.npy')
+
+    def load(self, file_name):
+        path = self.path(file_name)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def save(self, file_name, volume):
+        info = self._source_info(file_name)
+        path = self.path(file_name)
+        tmp_path = '%s.tmp.%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(volume, dtype=np.float32))
+        # atomic publish, concurrent writers of the same key produce identical files
+        os.replace(tmp_path, path)
+        with open(path[:-4] + '.json', 'w') as f:
+            json.dump(info, f)
+        return np.load(path, mmap_mode='r')
+
+    def get(self, file_name, build_fn):
+        volume = self.load(file_name)
+        if volume is None:
+            volume = self.save(file_name, build_fn(file_name))
+        return volume
+
+    def entries(self):
+        for desc_path in sorted(glob.glob(os.path.join(self.cache_dir, '*.json'))):
+            with open(desc_path) as f:
+                yield desc_path[:-5], json.load(f)
+
+    def prune(self):
+        """Remove entries whose source file changed, vanished or was built by an older pipeline."""
+        removed = 0
+        for stem, info in self.entries():
+            stale = info.get('version') != PREPROCESS_VERSION
+            if not stale:
+                try:
+                    st = os.stat(info['source'])
+                    stale = st.st_mtime_ns != info['mtime_ns'] or st.st_size != info['size']
+                except OSError:
+                    stale = True
+            if stale:
+                _remove(stem + '.npy')
+                _remove(stem + '.json')
+                removed += 1
+        return removed
+
+    def clear(self):
+        removed = 0
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npy*')) + \
+                glob.glob(os.path.join(self.cache_dir, '*.json')):
+            _remove(path)
+            removed += 1
+        return removed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def create_cache(args):
+    """Build the cache configured by ``--cache_dir`` or return None when caching is disabled."""
+    cache_dir = getattr(args, 'cache_dir', '')
+    if not cache_dir:
+        return None
+    return RSSCache(cache_dir, preprocess_tag(args))
+
+
+def preprocess_tag(args):
+    """Options that change the volumes of read_h5, '' for the default preprocessing."""
+    tags = []
+    # volumes read from the stored reconstruction_rss are not the k-space ones
+    rss_source = getattr(args, 'rss_source', 'kspace')
+    if rss_source != 'kspace':
+        tags.append('rss_source=' + rss_source)
+    # neither are the RSS of coil-compressed k-space
+    if getattr(args, 'virtual_coils', 0) > 0:
+        tags.append('virtual_coils=%d' % args.virtual_coils)
+    elif getattr(args, 'coil_energy', 0.) > 0:
+        tags.append('coil_energy=%g' % args.coil_energy)
+    return ','.join(tags)
+
+
+def _warm(path, cache, rss_source='kspace', engine=None):
+    from dataloader.dataset import read_h5
+    _, source = read_h5(path, cache, rss_source, True, engine)
+    return '%s (%s)' % (path, source)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='M4Raw RSS cache')
+    parser.add_argument('command', choices=['warm', 'prune', 'clear'])
+    parser.add_argument('--cache_dir', default='./rss_cache', type=str)
+    parser.add_argument('--data_root', default=[], type=str, action='append',
+                        help='folder with M4Raw .h5 files, may be given several times')
+    parser.add_argument('--workers', default=0, type=int, help='processes used by warm, 0 for serial')
+    parser.add_argument('--rss_source', default='kspace', type=str, help='kspace | auto, must match the training runs')
+    parser.add_argument('--virtual_coils', default=0, type=int, help='coil compression, must match the training runs')
+    parser.add_argument('--coil_energy', default=0., type=float, help='coil compression, must match the training runs')
+    args = parser.parse_args()
+
+    from dataloader.recon import create_engine
+    cache = create_cache(args)
+    engine = create_engine(args)
+    if args.command == 'warm':
+        paths = []
+        for data_root in args.data_root:
+            paths += sorted(glob.glob(os.path.join(data_root, '*.h5')))
+        if args.workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            from dataloader.dataset import _init_preprocess_worker
+            pool = ProcessPoolExecutor(args.workers, initializer=_init_preprocess_worker)
+            # the volumes are written to the cache by the workers, only the paths come back
+            results = pool.map(_warm, paths, [cache] * len(paths), [args.rss_source] * len(paths), [engine] * len(paths))
+        else:
+            pool = None
+            results = (_warm(path, cache, args.rss_source, engine) for path in paths)
+        for i, path in enumerate(results):
+            print('[%d/%d] %s' % (i + 1, len(paths), path))
+        if pool is not None:
+            pool.shutdown()
+    elif args.command == 'prune':
+        print('removed %d stale entries' % cache.prune())
+    else:
+        print('removed %d files' % cache.clear())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Node-local sharing of the preprocessed M4Raw arrays.
+
+With --shared_dataset the local rank 0 process builds the arrays once and writes them as
+.npy files to --shared_dir (/dev/shm by default). Every rank of the node and every
+DataLoader worker maps the same files read-only, so the host keeps a single copy
+whatever the number of GPUs and workers.
+"""
+import os
+import json
+import time
+import shutil
+import atexit
+import hashlib
+import numpy as np
+from dataloader.rss_cache import PREPROCESS_VERSION, preprocess_tag
+
+DONE_FILE = 'done'
+# bumped whenever the arrays returned by build_arrays change their layout
+LAYOUT_VERSION = 2
+FAILED_FILE = 'failed'
+# a failure marker older than the start of this process (minus the start-up skew of the ranks)
+# is left over from an earlier job, the local rank 0 of this job removes it
+MARKER_SLACK = 60
+_STARTED = time.time()
+
+
+def local_rank(args):
+    # torchrun exports LOCAL_RANK, torch.distributed.launch passes --local_rank
+    return int(os.environ.get('LOCAL_RANK', getattr(args, 'local_rank', 0)))
+
+
+def dataset_key(name, args, paths):
+    """Identify the arrays built from ``paths``, any changed input file gives a new key."""
+    parts = [name, PREPROCESS_VERSION, LAYOUT_VERSION, getattr(args, 'storage_dtype', 'float32'), getattr(args, 'rss_source', 'kspace'),
+             preprocess_tag(args)]
+    for path in paths:
+        st = os.stat(path)
+        parts.append([os.path.abspath(path), st.st_mtime_ns, st.st_size])
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def _remove_folder(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def _check_failed(failed_path):
+    try:
+        if os.path.getmtime(failed_path) < _STARTED - MARKER_SLACK:
+            return
+        with open(failed_path) as f:
+            error = f.read()
+    except OSError:
+        return
+    raise RuntimeError('local rank 0 failed to build the shared dataset %s: %s' % (os.path.dirname(failed_path), error))
+
+
+def node_shared(args, name, paths, build_fn, poll_interval=1.0):
+    """Return the dict of arrays of ``build_fn()`` built once per node.
+    Args:
+        args: Namespace, sharing is enabled by ``args.shared_dataset``.
+        name (str): Dataset name, part of the key.
+        paths (list): Source files, their path/mtime/size are part of the key.
+        build_fn (callable): Returns a dict of name -> np.ndarray or None.
+    Returns:
+        (arrays, files): arrays are read-only memmaps when shared, files maps every
+            shared array name to its .npy path (empty when sharing is disabled).
+    """
+    if not getattr(args, 'shared_dataset', False):
+        return build_fn(), {}
+
+    folder = os.path.join(getattr(args, 'shared_dir', '/dev/shm'),
+                          'm4raw_%s_%s' % (name, dataset_key(name, args, paths)))
+    done_path = os.path.join(folder, DONE_FILE)
+    failed_path = os.path.join(folder, FAILED_FILE)
+    if local_rank(args) == 0:
+        if not os.path.exists(done_path):
+            _remove_folder(folder)
+            os.makedirs(folder)
+            try:
+                arrays = build_fn()
+                names = []
+                for key, array in arrays.items():
+                    if array is None:
+                        continue
+                    tmp_path = os.path.join(folder, key + '.npy.tmp')
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, np.ascontiguousarray(array))
+                    os.replace(tmp_path, os.path.join(folder, key + '.npy'))
+                    names.append(key)
+                del arrays
+            except BaseException as e:
+                # the waiting ranks raise instead of polling forever, the marker stays for them
+                with open(failed_path, 'w') as f:
+                    f.write('%s: %s' % (type(e).__name__, e))
+                raise
+            with open(done_path, 'w') as f:
+                json.dump({'arrays': names}, f)
+            # /dev/shm is RAM, do not outlive the job that created it
+            atexit.register(_remove_folder, folder)
+    else:
+        # file based wait instead of a collective, building can exceed the NCCL timeout
+        while not os.path.exists(done_path):
+            _check_failed(failed_path)
+            time.sleep(poll_interval)
+
+    with open(done_path) as f:
+        names = json.load(f)['arrays']
+    files = dict((key, os.path.join(folder, key + '.npy')) for key in names)
+    arrays = dict((key, np.load(path, mmap_mode='r')) for key, path in files.items())
+    return arrays, files
+
+
+class SharedArrays(object):
+    """Dataset mixin: arrays listed in ``self.shared_files`` are pickled as their path.
+    Spawned DataLoader workers then map the node-local file again instead of
+    receiving a private copy of the whole dataset.
+    """
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in getattr(self, 'shared_files', {}):
+            state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key, path in getattr(self, 'shared_files', {}).items():
+            setattr(self, key, np.load(path, mmap_mode='r'))
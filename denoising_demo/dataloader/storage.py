@@ -0,0 +1,100 @@
+"""
+Storage precision of the in-memory M4Raw arrays.
+
+float32 is lossless with respect to read_h5, float16 halves it again and uint16 keeps
+a per-slice scale (slice max / 65535) so every slice uses the full 16 bit range.
+"""
+import math
+import numpy as np
+import torch
+
+STORAGE_DTYPES = ('float32', 'float16', 'uint16')
+UINT16_MAX = 65535.
+CHUNK = 256
+
+
+def quantize(x, storage_dtype='float32'):
+    """Convert a [N][...][high][width] array into its storage format.
+    Returns:
+        (stored, scales): scales has shape [N][...][1][1] for uint16 and is None otherwise.
+    """
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError('unknown storage dtype: %s' % storage_dtype)
+    if storage_dtype != 'uint16':
+        if x.dtype == np.dtype(storage_dtype):
+            return x, None
+        stored = np.empty(x.shape, dtype=storage_dtype)
+        for start in range(0, len(x), CHUNK):
+            stored[start:start+CHUNK] = x[start:start+CHUNK]
+        return stored, None
+
+    stored = np.empty(x.shape, dtype=np.uint16)
+    scales = np.empty(x.shape[:-2] + (1, 1), dtype=np.float32)
+    # chunked so that no full-size float temporary is ever allocated
+    for start in range(0, len(x), CHUNK):
+        chunk = np.asarray(x[start:start+CHUNK], dtype=np.float32)
+        scale = chunk.max(axis=(-2, -1), keepdims=True) / UINT16_MAX
+        scale[scale == 0] = 1. / UINT16_MAX
+        stored[start:start+CHUNK] = np.rint(chunk / scale)
+        scales[start:start+CHUNK] = scale
+    return stored, scales
+
+
+def dequantize(stored, scales=None):
+    """Float32 numpy array of stored samples, a view when nothing has to be converted."""
+    if scales is not None:
+        return stored.astype(np.float32) * scales
+    if stored.dtype == np.float32:
+        return stored
+    return stored.astype(np.float32)
+
+
+def to_tensor(stored, scales=None):
+    """Float32 tensor of stored samples, zero-copy for float32 storage."""
+    if scales is not None:
+        return torch.from_numpy(stored.astype(np.float32) * scales)
+    if stored.dtype == np.float32:
+        return torch.from_numpy(stored)
+    return torch.from_numpy(stored).float()
+
+
+def take(stored, scales, index, out):
+    """Float32 rows ``stored[index]`` written into ``out`` with one vectorized gather.
+    Args:
+        stored (np.ndarray): [N][...] storage array (or a reshaped view of it).
+        scales (np.ndarray): uint16 scales of stored, None otherwise.
+        index (np.ndarray): Row indices.
+        out (np.ndarray): float32 [len(index)][...] destination.
+    """
+    if scales is None and stored.dtype == np.float32:
+        return np.take(stored, index, axis=0, out=out)
+    rows = np.take(stored, index, axis=0)
+    if scales is None:
+        np.copyto(out, rows, casting='unsafe')
+    else:
+        np.multiply(rows, np.take(scales, index, axis=0), out=out, casting='unsafe')
+    return out
+
+
+def quantization_psnr(x, stored, scales=None):
+    """Worst-case (lowest) per-slice PSNR in dB of the stored copy against x, data range 1."""
+    worst_mse = 0.
+    for start in range(0, len(x), CHUNK):
+        chunk = np.asarray(x[start:start+CHUNK], dtype=np.float64)
+        restored = dequantize(stored[start:start+CHUNK],
+                              None if scales is None else scales[start:start+CHUNK])
+        mse = ((chunk - restored) ** 2).mean(axis=(-2, -1))
+        worst_mse = max(worst_mse, float(mse.max()))
+    if worst_mse == 0:
+        return float('inf')
+    return 10 * math.log10(1. / worst_mse)
+
+
+def store(x, storage_dtype='float32', name='array'):
+    """quantize() plus a printed report of the worst-case PSNR lost by the conversion."""
+    stored, scales = quantize(x, storage_dtype)
+    if stored is not x:
+        psnr = quantization_psnr(x, stored, scales)
+        print('%s stored as %s: %.1f MB, worst-case slice PSNR %.2f dB' %
+              (name, storage_dtype, stored.nbytes / 2**20, psnr))
+    return stored, scales
@@ -0,0 +1,234 @@
+"""
+Streaming training set for corpora that do not fit in memory.
+
+The data is stored in H5 shards holding ``images`` [n, repetitions, 256, 256] and
+``labels`` [n, 1, 256, 256] float32 datasets. Shards are cut into chunks of
+consecutive slices, the chunks are shuffled and the resulting sample sequence is cut
+into equal parts for the (rank, DataLoader worker) pairs, read by a background thread
+and mixed through a bounded shuffle buffer. Every rank yields the same number of samples
+(the last num_samples % world_size of an epoch are dropped), so the ranks of a
+distributed run end the epoch after the same number of batches.
+
+Pack M4Raw folders into shards from the denoising_demo folder:
+    python -m dataloader.stream --data_root /data0/M4RawV1.5/multicoil_train/ --modal T1 --out_dir ./shards
+Train on them:
+    python train.py --trainset StreamTrainSet --train_shards './shards/*.h5' ...
+Check the split over 2 gloo ranks with 2 spawned DataLoader workers each:
+    python -m dataloader.stream --train_shards './shards/*.h5' --check_ranks 2 --check_workers 2
+"""
+import os
+import glob
+import queue
+import argparse
+import threading
+import numpy as np
+import h5py
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+_END = object()
+
+
+class StreamTrainSet(IterableDataset):
+    def __init__(self, args):
+        patterns = [p for p in getattr(args, 'train_shards', '').split(',') if p]
+        self.shards = sorted(set(sum([glob.glob(p) for p in patterns], [])))
+        if len(self.shards) == 0:
+            raise ValueError('no shard matches --train_shards %s' % getattr(args, 'train_shards', ''))
+        self.chunk_size = getattr(args, 'stream_chunk', 32)
+        self.buffer_size = getattr(args, 'shuffle_buffer', 2048)
+        self.prefetch = getattr(args, 'stream_prefetch', 4)
+        self.seed = getattr(args, 'random_seed', 0)
+        self.epoch = 0
+        # read in the training process: spawned DataLoader workers have no process group
+        self.rank, self.world_size = self._world()
+
+        # (shard, start, stop) units, every unit is one contiguous hyperslab read
+        self.units = []
+        for shard in self.shards:
+            with h5py.File(shard, 'r') as hf:
+                num_samples = hf['labels'].shape[0]
+            for start in range(0, num_samples, self.chunk_size):
+                self.units.append((shard, start, min(start + self.chunk_size, num_samples)))
+        self.num_samples = sum(stop - start for _, start, stop in self.units)
+        print('StreamTrainSet: %d shards, %d samples' % (len(self.shards), self.num_samples))
+
+    def __len__(self):
+        # samples yielded by one rank per epoch
+        return self.num_samples // self.world_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @staticmethod
+    def _world():
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def _my_units(self):
+        rank, world_size = self.rank, self.world_size
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        consumer = rank * num_workers + worker_id
+        # every rank gets per_rank samples, split over its workers with the same sizes on every rank,
+        # so drop_last leaves the same number of batches on every rank
+        per_rank = self.num_samples // world_size
+        first = rank * per_rank + worker_id * per_rank // num_workers
+        last = rank * per_rank + (worker_id + 1) * per_rank // num_workers
+        # identical unit order on every consumer, each one reads its own range of the sample sequence
+        order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.units))
+        units, position = [], 0
+        for k in order:
+            shard, start, stop = self.units[k]
+            lo, hi = max(first, position), min(last, position + stop - start)
+            if lo < hi:
+                units.append((shard, start + lo - position, start + hi - position))
+            position += stop - start
+            if position >= last:
+                break
+        return units, consumer
+
+    def _reader(self, units, out, stop):
+        try:
+            for shard, start, end in units:
+                if stop.is_set():
+                    return
+                with h5py.File(shard, 'r') as hf:
+                    chunk = (hf['images'][start:end], hf['labels'][start:end])
+                out.put(chunk)
+        finally:
+            out.put(_END)
+
+    def __iter__(self):
+        units, consumer = self._my_units()
+        rng = np.random.default_rng([self.seed, self.epoch, consumer])
+        self.epoch += 1
+
+        chunks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._reader, args=(units, chunks, stop), daemon=True)
+        reader.start()
+
+        buffer = []
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _END:
+                    break
+                images, labels = chunk
+                for k in range(len(labels)):
+                    buffer.append((images[k], labels[k]))
+                    if len(buffer) >= self.buffer_size:
+                        # swap a random entry to the end and emit it
+                        pick = rng.integers(len(buffer))
+                        buffer[pick], buffer[-1] = buffer[-1], buffer[pick]
+                        yield self._sample(buffer.pop(), rng)
+            rng.shuffle(buffer)
+            while buffer:
+                yield self._sample(buffer.pop(), rng)
+        finally:
+            stop.set()
+            # unblock a reader waiting on a full queue
+            while reader.is_alive():
+                try:
+                    chunks.get_nowait()
+                except queue.Empty:
+                    reader.join(0.1)
+
+    def _sample(self, pair, rng):
+        images, labels = pair
+        choisce = rng.integers(len(images))
+        return {'images': torch.from_numpy(np.ascontiguousarray(images[choisce:choisce+1], dtype=np.float32)),
+                'labels': torch.from_numpy(np.ascontiguousarray(labels, dtype=np.float32))}
+
+
+def pack_shards(args):
+    """Write the M4Raw pairs of args.data_root as shards of at most args.shard_size slices."""
+    from dataloader.dataset import get_file_lists, read_h5
+    from dataloader.rss_cache import create_cache
+    cache = create_cache(args)
+    os.makedirs(args.out_dir, exist_ok=True)
+    all = get_file_lists(args.data_root, args.modal)
+    shard_idx, hf = 0, None
+    for j in range(len(all[0])):
+        images = np.stack([read_h5(paths[j], cache, args.rss_source) for paths in all], axis=1).astype(np.float32)
+        labels = images.mean(axis=1, keepdims=True, dtype=np.float64).astype(np.float32)
+        if hf is None or hf['labels'].shape[0] + len(labels) > args.shard_size:
+            if hf is not None:
+                hf.close()
+                shard_idx += 1
+            path = os.path.join(args.out_dir, '%s_%s_%05d.h5' % (args.prefix, args.modal, shard_idx))
+            hf = h5py.File(path, 'w')
+            size = images.shape[2:]
+            hf.create_dataset('images', shape=(0, len(all)) + size, maxshape=(None, len(all)) + size,
+                              dtype=np.float32, chunks=(1, len(all)) + size)
+            hf.create_dataset('labels', shape=(0, 1) + size, maxshape=(None, 1) + size,
+                              dtype=np.float32, chunks=(1, 1) + size)
+            print('writing %s' % path)
+        n = hf['labels'].shape[0]
+        for key, value in (('images', images), ('labels', labels)):
+            hf[key].resize(n + len(value), axis=0)
+            hf[key][n:] = value
+    if hf is not None:
+        hf.close()
+
+
+def _check_rank(rank, args, results):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.check_port))
+    dist.init_process_group('gloo', rank=rank, world_size=args.check_ranks)
+    try:
+        dataset = StreamTrainSet(args)
+        # spawned workers like in train.py, which sets the spawn start method for distributed training
+        loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=args.check_workers,
+                                             multiprocessing_context='spawn' if args.check_workers > 0 else None)
+        sums = [float(sample['labels'].double().sum()) for sample in loader]
+        results[rank] = (len(dataset), sums)
+    finally:
+        dist.destroy_process_group()
+
+
+def check_ranks(args):
+    """Iterate StreamTrainSet on args.check_ranks gloo ranks, every rank has to yield len() samples
+    and the ranks disjoint parts of the shards."""
+    import torch.multiprocessing as mp
+    results = mp.Manager().dict()
+    mp.spawn(_check_rank, args=(args, results), nprocs=args.check_ranks)
+    seen = []
+    for rank in range(args.check_ranks):
+        length, sums = results[rank]
+        print('rank %d: %d samples, len() %d, checksum %.3f' % (rank, len(sums), length, sum(sums)))
+        if len(sums) != length:
+            raise AssertionError('rank %d yielded %d samples, len() is %d' % (rank, len(sums), length))
+        seen += sums
+    if len(set(seen)) != len(seen):
+        raise AssertionError('the ranks yielded %d duplicate samples' % (len(seen) - len(set(seen))))
+    print('ok: equal and disjoint per-rank samples')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pack M4Raw pairs into StreamTrainSet shards')
+    parser.add_argument('--data_root', default='/data0/M4RawV1.5/multicoil_train/', type=str)
+    parser.add_argument('--modal', default='T1', type=str, help='T1 | T2 | FLAIR')
+    parser.add_argument('--out_dir', default='./shards', type=str)
+    parser.add_argument('--prefix', default='m4raw', type=str, help='shard name prefix, e.g. the site name')
+    parser.add_argument('--shard_size', default=2048, type=int, help='slices per shard')
+    parser.add_argument('--cache_dir', default='', type=str)
+    parser.add_argument('--rss_source', default='kspace', type=str, help='kspace | auto')
+    parser.add_argument('--train_shards', default='', type=str, help='check: comma separated shard globs')
+    parser.add_argument('--check_ranks', default=0, type=int, help='check the rank split on this many gloo ranks instead of packing')
+    parser.add_argument('--check_workers', default=2, type=int, help='check: DataLoader workers per rank')
+    parser.add_argument('--check_port', default=29517, type=int)
+    parser.add_argument('--stream_chunk', default=32, type=int)
+    parser.add_argument('--shuffle_buffer', default=2048, type=int)
+    args = parser.parse_args()
+    if args.check_ranks > 0:
+        check_ranks(args)
+    else:
+        pack_shards(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Micro-batching with gradient accumulation.
+
+``--batch_size`` stays the batch of one optimizer step. ``--accum_steps 4`` splits every training
+batch into 4 micro-batches whose gradients are accumulated before the step, so only the
+activations of a micro-batch are held at a time. ``--micro_memory 6000`` picks the largest
+micro-batch whose activations (the tensors autograd saves for the backward pass) fit in 6000 MB,
+measured on the network for every new input size. The losses of the micro-batches are weighted
+by their share of the batch, so the gradients match those of the whole batch; with
+DistributedDataParallel the gradients are only all-reduced after the last micro-batch.
+"""
+import math
+import logging
+import contextlib
+import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+
+def activation_bytes(net, images, amp=None):
+    """Bytes of the distinct tensors autograd saves during a forward pass of net on images."""
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    context = amp.autocast() if amp is not None else contextlib.nullcontext()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor), context:
+        output = net(images)
+    del output
+    return sum(storages.values())
+
+
+class MicroBatcher(object):
+    """
+    Args:
+        accum_steps (int): Micro-batches per training batch, used when memory_budget is 0.
+        memory_budget (float): MB of activations per micro-batch, 0 to split by accum_steps.
+    """
+
+    def __init__(self, accum_steps=1, memory_budget=0):
+        if accum_steps < 1:
+            raise ValueError('--accum_steps has to be at least 1, got %d' % accum_steps)
+        self.accum_steps = accum_steps
+        self.memory_budget = memory_budget
+        # input shape [channels][high][width] -> micro-batch size
+        self.sizes = {}
+
+    def fit(self, net, images, amp=None):
+        """Largest micro-batch of images fitting the memory budget, from probes with 1 and 2 samples.
+        The state of net (e.g. batch norm statistics) is restored after the probes."""
+        devices = 1
+        if isinstance(net, nn.DataParallel):
+            # the micro-batch is scattered over the GPUs, every GPU holds its share of the activations
+            devices = max(len(net.device_ids), 1)
+        if isinstance(net, (nn.DataParallel, DistributedDataParallel)):
+            net = net.module
+        state = dict((k, v.clone()) for k, v in net.state_dict().items())
+        try:
+            one = activation_bytes(net, images[:1], amp)
+            two = activation_bytes(net, images[:1].expand(2, *images.shape[1:]).contiguous(), amp)
+        finally:
+            net.load_state_dict(state)
+        per_sample = max(two - one, 1)
+        fixed = max(one - per_sample, 0)
+        budget = self.memory_budget * 2**20
+        size = int((budget - fixed) // per_sample) * devices
+        if size < 1:
+            logging.warning('one sample needs %.0f MB of activations, above --micro_memory %.0f MB' %
+                            (one / 2**20, self.memory_budget))
+        return max(size, 1)
+
+    def micro_batch_size(self, net, images, amp=None):
+        batch = images.size(0)
+        if self.memory_budget <= 0:
+            return int(math.ceil(batch / float(self.accum_steps)))
+        shape = tuple(images.shape[1:])
+        if shape not in self.sizes:
+            self.sizes[shape] = self.fit(net, images, amp)
+            logging.info('micro-batch of %d samples for %s inputs (--micro_memory %.0f MB)' %
+                         (self.sizes[shape], 'x'.join(str(s) for s in shape), self.memory_budget))
+        return min(self.sizes[shape], batch)
+
+    def split(self, net, images, labels, amp=None):
+        """[(images, labels)] micro-batches of a training batch, one element without accumulation."""
+        size = self.micro_batch_size(net, images, amp)
+        if size >= images.size(0):
+            return [(images, labels)]
+        return list(zip(torch.split(images, size), torch.split(labels, size)))
+
+    @staticmethod
+    def no_sync(net, accumulate):
+        """DistributedDataParallel.no_sync while accumulate is True, no-op otherwise."""
+        if accumulate and isinstance(net, DistributedDataParallel):
+            return net.no_sync()
+        return contextlib.nullcontext()
+
+
+def create_micro_batcher(args):
+    """MicroBatcher of --accum_steps / --micro_memory."""
+    return MicroBatcher(getattr(args, 'accum_steps', 1), getattr(args, 'micro_memory', 0))
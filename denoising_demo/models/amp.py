@@ -0,0 +1,100 @@
+"""
+Mixed-precision training.
+
+``--amp fp16`` runs the forward pass and the losses under torch.autocast in float16, with dynamic
+loss scaling (GradScaler) so small gradients do not flush to zero. ``--amp bf16`` uses bfloat16,
+which has the float32 exponent range and needs no scaling; it also runs on the CPU. The weights,
+the optimizer state and the reductions autocast keeps in float32 stay float32.
+
+``--amp_bench 20`` times 20 float32 and 20 mixed-precision steps on the first training batch
+before the training starts and logs the throughput gain.
+"""
+import time
+import logging
+import torch
+import torch.nn as nn
+
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class MixedPrecision(object):
+    """
+    Args:
+        mode (str): 'off' | 'fp16' | 'bf16'.
+        device (torch.device): Device of the network, selects the autocast backend.
+    """
+
+    def __init__(self, mode='off', device='cpu'):
+        if mode != 'off' and mode not in AMP_DTYPES:
+            raise ValueError('unknown amp mode: %s' % mode)
+        self.mode = mode
+        self.device_type = torch.device(device).type
+        if mode == 'bf16' and self.device_type == 'cuda' and not torch.cuda.is_bf16_supported():
+            raise ValueError('--amp bf16 is not supported by this GPU, use --amp fp16')
+        self.dtype = AMP_DTYPES.get(mode, torch.float32)
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=mode == 'fp16')
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def autocast(self, enabled=True):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled and enabled)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        """optimizer.step, skipped by the scaler when the scaled gradients overflowed."""
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.scaler.load_state_dict(state_dict)
+
+
+def create_amp(args):
+    """MixedPrecision of --amp on args.device, a no-op with --amp off."""
+    return MixedPrecision(getattr(args, 'amp', 'off'), args.device)
+
+
+def _time_steps(net, images, labels, amp, steps):
+    criterion = nn.L1Loss()
+    for step in range(steps + 1):
+        if step == 1:
+            # the first step pays for the cudnn autotuning and the allocations
+            if images.is_cuda:
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+        with amp.autocast():
+            loss = criterion(net(images).float(), labels)
+        amp.scaler.scale(loss).backward()
+        net.zero_grad(set_to_none=True)
+    if images.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / max(steps, 1)
+
+
+def benchmark(net, images, labels, amp, steps=20):
+    """Seconds per forward / backward step of net in float32 and under amp.
+    The parameters and buffers (e.g. batch norm statistics) of net are restored afterwards.
+    Returns:
+        (float32 seconds, amp seconds)
+    """
+    state = dict((k, v.clone()) for k, v in net.state_dict().items())
+    try:
+        fp32 = _time_steps(net, images, labels, MixedPrecision('off', images.device), steps)
+        mixed = _time_steps(net, images, labels, MixedPrecision(amp.mode, images.device), steps)
+    finally:
+        net.load_state_dict(state)
+    return fp32, mixed
+
+
+def log_benchmark(net, images, labels, amp, steps=20):
+    fp32, mixed = benchmark(net, images, labels, amp, steps)
+    batch = images.size(0)
+    logging.info('amp %s: %.1f samples/s, float32: %.1f samples/s, speedup %.2fx' %
+                 (amp.mode, batch / mixed, batch / fp32, fp32 / mixed))
@@ -104,30 +104,35 @@ class Local_Base():
             self.forward(imgs)
 class LayerNormFunction(torch.autograd.Function):
 
+    # the statistics are computed in float32 whatever the input dtype: under fp16 autocast
+    # (x - mu)^2 overflows and eps=1e-6 is below the float16 resolution of var + eps
     @staticmethod
     def forward(ctx, x, weight, bias, eps):
         ctx.eps = eps
+        ctx.dtype = x.dtype
         N, C, H, W = x.size()
+        x = x.to(torch.promote_types(x.dtype, torch.float32))
         mu = x.mean(1, keepdim=True)
         var = (x - mu).pow(2).mean(1, keepdim=True)
         y = (x - mu) / (var + eps).sqrt()
         ctx.save_for_backward(y, var, weight)
-        y = weight.view(1, C, 1, 1) * y + bias.view(1, C, 1, 1)
-        return y
+        y = weight.to(x.dtype).view(1, C, 1, 1) * y + bias.to(x.dtype).view(1, C, 1, 1)
+        return y.to(ctx.dtype)
 
     @staticmethod
     def backward(ctx, grad_output):
         eps = ctx.eps
 
         N, C, H, W = grad_output.size()
-        y, var, weight = ctx.saved_variables
-        g = grad_output * weight.view(1, C, 1, 1)
+        y, var, weight = ctx.saved_tensors
+        grad_output = grad_output.to(y.dtype)
+        g = grad_output * weight.to(y.dtype).view(1, C, 1, 1)
         mean_g = g.mean(dim=1, keepdim=True)
 
         mean_gy = (g * y).mean(dim=1, keepdim=True)
         gx = 1. / torch.sqrt(var + eps) * (g - y * mean_gy - mean_g)
-        return gx, (grad_output * y).sum(dim=3).sum(dim=2).sum(dim=0), grad_output.sum(dim=3).sum(dim=2).sum(
-            dim=0), None
+        return gx.to(ctx.dtype), (grad_output * y).sum(dim=3).sum(dim=2).sum(dim=0).to(weight.dtype), grad_output.sum(
+            dim=3).sum(dim=2).sum(dim=0).to(weight.dtype), None
 
 class LayerNorm2d(nn.Module):
 
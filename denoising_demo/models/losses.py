@@ -1,4 +1,5 @@
 import math
+import contextlib
 import torch
 from torch import autograd as autograd
 from torch import nn as nn
@@ -497,7 +498,7 @@ class VGGStyleDiscriminator160(nn.Module):
 ## relative gan
 class AdversarialLoss(nn.Module):
     def __init__(self, use_cpu=False, gpu_ids=[], dist=False, gan_type='RGAN', gan_k=2,
-                 lr_dis=1e-4, train_crop_size=40):
+                 lr_dis=1e-4, train_crop_size=40, amp='off'):
 
         super(AdversarialLoss, self).__init__()
         self.gan_type = gan_type
@@ -511,10 +512,12 @@ class AdversarialLoss(nn.Module):
 
         self.optimizer = torch.optim.Adam(
                 self.discriminator.parameters(),
-                betas=(0, 0.9), eps=1e-8, lr=lr_dis
+                betas=(0., 0.9), eps=1e-8, lr=lr_dis
             )
 
         self.criterion_adv = GANLoss(gan_type='vanilla').to(self.device)
+        # loss scaling of the discriminator updates with --amp fp16
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=amp == 'fp16')
 
     def set_requires_grad(self, nets, requires_grad=False):
         """Set requies_grad=Fasle for all the networks to avoid unnecessary computations
@@ -529,37 +532,53 @@ class AdversarialLoss(nn.Module):
                 for param in net.parameters():
                     param.requires_grad = requires_grad
 
-    def forward(self, fake, real):
+    def generator_loss(self, fake, real):
+        """Relativistic G loss of a (micro-)batch with the discriminator frozen,
+        computed under the autocast of the trainer."""
+        self.set_requires_grad(self.discriminator, False)
+        d_real = self.discriminator(real).detach()
+        d_fake = self.discriminator(fake)
+        g_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), False, is_disc=False) * 0.5
+        g_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real), True, is_disc=False) * 0.5
+        return g_real_loss + g_fake_loss
 
-        # D Loss
+    def update_discriminator(self, fake, real, amp=None):
+        """gan_k discriminator steps on the detached outputs of a whole optimizer step.
+        Only the forward passes and the losses run under amp.autocast (MixedPrecision),
+        the scaled backward passes and the steps run outside of it.
+        Returns:
+            the discriminator loss of the last step
+        """
+        fake, real = fake.detach(), real.detach()
+        autocast = amp.autocast if amp is not None else contextlib.nullcontext
+        self.set_requires_grad(self.discriminator, True)
         for _ in range(self.gan_k):
-            self.set_requires_grad(self.discriminator, True)
             self.optimizer.zero_grad()
             # real
-            d_fake = self.discriminator(fake).detach()
-            d_real = self.discriminator(real)
-            d_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), True,
-                                               is_disc=True) * 0.5
-            d_real_loss.backward()
+            with autocast():
+                d_fake = self.discriminator(fake).detach()
+                d_real = self.discriminator(real)
+                d_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), True,
+                                                   is_disc=True) * 0.5
+            self.scaler.scale(d_real_loss).backward()
             # fake
-            d_fake = self.discriminator(fake.detach())
-            d_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real.detach()), False,
-                                                is_disc=True) * 0.5
-            d_fake_loss.backward()
-            loss_d = d_real_loss + d_fake_loss
-            
-            self.optimizer.step()
-
-        # G Loss
+            with autocast():
+                d_fake = self.discriminator(fake)
+                d_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real.detach()), False,
+                                                    is_disc=True) * 0.5
+            self.scaler.scale(d_fake_loss).backward()
+            loss_d = d_real_loss.detach() + d_fake_loss.detach()
+
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
         self.set_requires_grad(self.discriminator, False)
-        d_real = self.discriminator(real).detach()
-        d_fake = self.discriminator(fake)
-        g_real_loss = self.criterion_adv(d_real - torch.mean(d_fake), False, is_disc=False) * 0.5
-        g_fake_loss = self.criterion_adv(d_fake - torch.mean(d_real), True, is_disc=False) * 0.5
-        loss_g = g_real_loss + g_fake_loss
+        return loss_d
 
-        # Generator loss
-        return loss_g, loss_d
+    def forward(self, fake, real, amp=None):
+        """Discriminator steps, then the G loss of the whole batch.
+        The trainer calls generator_loss per micro-batch and update_discriminator once per step instead."""
+        loss_d = self.update_discriminator(fake, real, amp)
+        return self.generator_loss(fake, real), loss_d
 
     def state_dict(self):
         D_state_dict = self.discriminator.state_dict()
@@ -0,0 +1,90 @@
+"""
+Progressive resolution training.
+
+``--progressive 0:64,40:128,100:256`` trains on 64x64 inputs from epoch 0, 128x128 from
+epoch 40 and full slices from epoch 100. The inputs are downsampled (``--progressive_mode
+resize``) or cropped (``crop``) on the device and the batch size of the training loader is
+scaled by (full / size)^2, so every step holds about the same number of pixels.
+"""
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from dataloader.augment import PatchSampler
+
+
+def size_multiple(net):
+    """Input sizes of the network have to be multiples of this value."""
+    if isinstance(net, (nn.DataParallel, DistributedDataParallel)):
+        net = net.module
+    if hasattr(net, 'padder_size'):
+        # NAFNET pads to a multiple of padder_size, other sizes would waste the padding
+        return net.padder_size
+    if hasattr(net, 'wavedown'):
+        # UNetWaveletNet: one dwt2d halves the size at every level
+        return 2 ** len(net.wavedown)
+    if hasattr(net, 'down_sample_layers'):
+        # UNET / UnetModel: one 2x2 pooling per down-sampling layer
+        return 2 ** len(net.down_sample_layers)
+    return 1
+
+
+def check_size(net, size, name='input size'):
+    multiple = size_multiple(net)
+    if size % multiple != 0:
+        net_name = (net.module if hasattr(net, 'module') else net).__class__.__name__
+        raise ValueError('%s %d is not a multiple of %d required by %s' % (name, size, multiple, net_name))
+
+
+class ProgressiveSchedule(object):
+    """
+    Args:
+        stages (list): (start epoch, size) pairs.
+        full_size (int): Side of the loaded slices.
+        mode (str): 'resize' (area downsampling) | 'crop' (foreground-weighted random crops).
+    """
+
+    def __init__(self, stages, full_size=256, mode='resize', device='cpu', seed=0):
+        if mode not in ('resize', 'crop'):
+            raise ValueError('unknown progressive mode: %s' % mode)
+        self.stages = sorted(stages)
+        self.full_size = full_size
+        self.mode = mode
+        self.cropper = PatchSampler(full_size, 1, device=device, seed=seed)
+
+    @staticmethod
+    def parse(spec):
+        stages = []
+        for item in spec.split(','):
+            epoch, size = item.split(':')
+            stages.append((int(epoch), int(size)))
+        return stages
+
+    def size_at(self, epoch):
+        size = self.full_size
+        for start, stage_size in self.stages:
+            if epoch >= start:
+                size = stage_size
+        return size
+
+    def batch_size(self, base_batch_size, size, world_size=1):
+        """Batch size with the pixels of base_batch_size full slices, a multiple of world_size."""
+        scaled = base_batch_size * (self.full_size // size) ** 2
+        return max(world_size, scaled // world_size * world_size)
+
+    def __call__(self, images, labels, size):
+        if size >= min(images.shape[-2:]):
+            return images, labels
+        if self.mode == 'resize':
+            return F.interpolate(images, size=(size, size), mode='area'), F.interpolate(labels, size=(size, size), mode='area')
+        self.cropper.crop_size = size
+        return self.cropper(images, labels)
+
+
+def create_schedule(args):
+    """ProgressiveSchedule of --progressive, None for fixed-resolution training."""
+    spec = getattr(args, 'progressive', '')
+    if not spec:
+        return None
+    seed = getattr(args, 'random_seed', 0) * 1000 + max(getattr(args, 'rank', 0), 0) + 900
+    return ProgressiveSchedule(ProgressiveSchedule.parse(spec), 256, getattr(args, 'progressive_mode', 'resize'),
+                               args.device, seed)
@@ -3,6 +3,7 @@ import time
 import logging
 import itertools
 import math
+import copy
 import numpy as np
 import random
 from PIL import Image
@@ -12,11 +13,10 @@ from matplotlib import pyplot as plt
 import torch
 import torch.nn as nn
 from torch.nn.parallel import DistributedDataParallel
-from torch.autograd import Variable
 from torch.optim.lr_scheduler import CosineAnnealingLR
 import torchvision
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset
 from collections import OrderedDict
 import importlib
 import sys
@@ -25,7 +25,14 @@ from dataloader.dataset import TrainSet #, TestSet , TestSet_multi, Urban100, Su
 from utils import util, calculate_PSNR_SSIM
 from models.modules import define_G
 from models.losses import PerceptualLoss, AdversarialLoss
-from dataloader import DistIterSampler, create_dataloader
+from dataloader import DistIterSampler, create_dataloader, create_batch_dataloader, supports_batch_fetch
+from dataloader import MultiEpochsDataLoader, create_test_dataloader, LoaderPool
+from dataloader.noise import create_noise
+from dataloader.prefetch import DevicePrefetcher
+from dataloader.augment import create_augment, create_patches
+from models.schedule import create_schedule, check_size
+from models.amp import create_amp, log_benchmark
+from models.accumulate import create_micro_batcher
 from skimage.metrics import peak_signal_noise_ratio,structural_similarity,normalized_root_mse
 
 
@@ -38,11 +45,18 @@ class Trainer(object):
         args.device = self.device
 
         ## init dataloader
+        # persistent worker pools of the training and test loaders
+        self.loaders = LoaderPool()
         if args.phase == 'train':
             # In train.py, the default value for the --trainset parameter passed through args is set to 'Trainset', which corresponds to：
             # Specify the use of dataset.py in the dataloader folder, creating an instance trainset_ of the Trainset class.
             trainset_ = getattr(importlib.import_module('dataloader.dataset'), args.trainset, None)
-            if args.modal == 'ALL':
+            if getattr(args, 'device_noise', '') and not getattr(trainset_, 'clean_uint8', False):
+                # the other train sets return float labels and add the noise themselves
+                raise ValueError('--device_noise needs a train set returning clean uint8 slices '
+                                 '(FastMRITrainSet, PackedFastMRITrainSet), got %s' % args.trainset)
+            # TrainSet / TestSet hold all contrasts themselves, the other datasets are concatenated per contrast
+            if args.modal == 'ALL' and not issubclass(trainset_, IterableDataset) and not getattr(trainset_, 'multi_contrast', False):
                 self.args.modal = 'T1'
                 self.train_dataset1 = trainset_(self.args)
                 self.args.modal = 'T2'
@@ -52,24 +66,50 @@ class Trainer(object):
                 self.train_dataset = self.train_dataset1 + self.train_dataset2 + self.train_dataset3
             else:
                 self.train_dataset = trainset_(self.args)
-            ## Initialize the distributed training data loader.
-            if args.dist: 
+            ## Initialize the training sampler: seeded epoch permutations, split over the ranks when distributed.
+            ## Its position (epoch, offset) is saved with the checkpoints and restored by --resume_sampler.
+            self.train_sampler = None
+            self.resume_offset = 0
+            if not isinstance(self.train_dataset, IterableDataset):
                 dataset_ratio = 1
-                train_sampler = DistIterSampler(self.train_dataset, args.world_size, args.rank, dataset_ratio)
-                self.train_dataloader = create_dataloader(self.train_dataset, args, train_sampler)
-            else:
-                self.train_dataloader = DataLoader(self.train_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True)
+                world_size, rank = (args.world_size, args.rank) if args.dist else (1, 0)
+                self.train_sampler = DistIterSampler(self.train_dataset, world_size, rank, dataset_ratio,
+                                                     seed=getattr(args, 'random_seed', 0))
+                self.train_sampler.set_epoch(args.start_iter)
+                if getattr(args, 'resume_sampler', ''):
+                    state = torch.load(args.resume_sampler)
+                    self.train_sampler.load_state_dict(state)
+                    args.start_iter, self.resume_offset = state['epoch'], state['offset']
+                    if args.rank <= 0:
+                        logging.info('resuming training at epoch %d, sample %d' % (state['epoch'], state['offset']))
+            self.train_dataloader = self.loaders.add('train', self.create_train_dataloader(args.batch_size))
+            ## noise added to the clean uint8 batches on the device (--device_noise)
+            self.noise = create_noise(args, getattr(trainset_, 'sigma_range', (8, 15)))
+            ## batched flips / rot90 / crops / intensity scaling, applied while self.augmentation is on
+            self.augment = create_augment(args)
+            ## patch training: several random crops per slice, evaluation stays full-frame
+            self.patches = create_patches(args)
+            ## progressive resolution: smaller inputs and larger batches in the first epochs
+            self.schedule = create_schedule(args)
 
         # In train.py, the default value for the --testset parameter passed through args is set to 'Testset', which corresponds to:
         # Specify the use of dataset.py in the dataloader folder, creating an instance testset_ of the Testset class.
         testset_ = getattr(importlib.import_module('dataloader.dataset'), args.testset, None)
         self.test_dataset = testset_(self.args)
-        self.test_dataloader = DataLoader(self.test_dataset, batch_size=1, num_workers=args.num_workers, shuffle=False)
+        self.test_dataloader = self.loaders.add('test', create_test_dataloader(self.test_dataset, args))
 
         ## init network
         self.net = define_G(args)
         if args.resume:
             self.load_networks('net', self.args.resume)
+        if args.phase == 'train':
+            # training input sizes have to fit the down-sampling of the network
+            sizes = [('--crop_size', getattr(args, 'crop_size', 0)), ('--aug_crop', getattr(args, 'aug_crop', 0))]
+            if self.schedule is not None:
+                sizes += [('--progressive size', size) for _, size in self.schedule.stages]
+            for name, size in sizes:
+                if size > 0:
+                    check_size(self.net, size, name)
 
         if args.rank <= 0:
             logging.info('----- generator parameters: %f -----' % (sum(param.numel() for param in self.net.parameters()) / (10**6)))
@@ -95,7 +135,8 @@ class Trainer(object):
 
             if args.loss_adv:
                 self.criterion_adv = AdversarialLoss(gpu_ids=args.gpu_ids, dist=args.dist, gan_type=args.gan_type,
-                                                             gan_k=1, lr_dis=args.lr_D, train_crop_size=40)
+                                                             gan_k=1, lr_dis=args.lr_D, train_crop_size=40,
+                                                             amp=getattr(args, 'amp', 'off'))
                 self.lambda_adv = args.lambda_adv
                 if args.rank <= 0:
                     logging.info('  using adv loss...')
@@ -103,12 +144,40 @@ class Trainer(object):
             # The original project used the Adam optimizer, and here it has been replaced with the AdamW optimizer.
             self.optimizer_G = torch.optim.AdamW(itertools.chain.from_iterable(g_params), lr=args.lr, weight_decay=args.weight_decay)  
             self.scheduler = CosineAnnealingLR(self.optimizer_G, T_max=500)  # T_max=args.max_iter
+            ## mixed precision (--amp): autocast of the forward and the losses, loss scaling for fp16
+            self.amp = create_amp(args)
+            if args.rank <= 0 and self.amp.enabled:
+                logging.info('  using %s mixed precision...' % self.amp.mode)
+            ## micro-batches with gradient accumulation (--accum_steps / --micro_memory)
+            self.micro = create_micro_batcher(args)
 
             if args.resume_optim:
                 self.load_networks('optimizer_G', self.args.resume_optim)
             if args.resume_scheduler:
                 self.load_networks('scheduler', self.args.resume_scheduler)
 
+    def create_train_dataloader(self, batch_size, epoch=None, offset=0):
+        """Training loader with a global batch of batch_size samples, starting at sample offset of epoch
+        (at the current position of the sampler if epoch is None)."""
+        args = self.args
+        if self.train_sampler is not None and epoch is not None:
+            self.train_sampler.load_state_dict({'epoch': epoch, 'offset': offset})
+        if supports_batch_fetch(self.train_dataset):
+            # in-memory datasets gather whole batches, no per-sample __getitem__ and collation
+            return create_batch_dataloader(self.train_dataset, args, batch_size, self.train_sampler)
+        elif isinstance(self.train_dataset, IterableDataset):
+            # streaming datasets deal their shards over ranks and workers themselves
+            batch_size = batch_size // args.world_size if args.dist else batch_size
+            return DataLoader(self.train_dataset, batch_size=batch_size, num_workers=args.num_workers,
+                              pin_memory=True, drop_last=True, persistent_workers=args.num_workers > 0)
+        elif args.dist:
+            loader_args = copy.copy(args)
+            loader_args.batch_size = batch_size
+            return create_dataloader(self.train_dataset, loader_args, self.train_sampler)
+        else:
+            return MultiEpochsDataLoader(self.train_dataset, batch_size=batch_size, num_workers=args.num_workers,
+                                         sampler=self.train_sampler)
+
     def set_learning_rate(self, optimizer, epoch):
         current_lr = self.args.lr * 0.3**(epoch//550)
         optimizer.param_groups[0]['lr'] = current_lr
@@ -136,14 +205,33 @@ class Trainer(object):
     def prepare(self, batch_samples):
         for key in batch_samples.keys():
             if 'name' not in key and 'pad_nums' not in key:
-                batch_samples[key] = Variable(batch_samples[key].to(self.device), requires_grad=False)
+                # no-op for batches already staged on the device by DevicePrefetcher
+                batch_samples[key] = batch_samples[key].to(self.device, non_blocking=True)
         return batch_samples
 
+    def compute_losses(self, output, labels):
+        """Weighted sum of the training losses and OrderedDict of the single losses."""
+        loss = 0
+        losses = OrderedDict()
+        if self.args.loss_mse:
+            losses['mse_loss'] = self.criterion_mse(output, labels) * self.lambda_mse
+            loss += losses['mse_loss']
+        if self.args.loss_l1: # Default is L1 loss.
+            losses['l1_loss'] = self.criterion_l1(output, labels) * self.lambda_l1
+            loss += losses['l1_loss']
+        if self.args.loss_adv:
+            # the discriminator is updated once per optimizer step, after the micro-batches
+            losses['adv_loss'] = self.criterion_adv.generator_loss(output, labels) * self.lambda_adv
+            loss += losses['adv_loss']
+        return loss, losses
+
     def train(self):
         if self.args.rank <= 0:
             logging.info('training on  ...' + self.args.dataset)
             logging.info('%d training samples' % (self.train_dataset.__len__()))
             logging.info('the init lr: %f'%(self.args.lr))
+            if self.patches is not None:
+                logging.info('patch training: %d patches of %dx%d per slice' % (self.patches.patches_per_slice, self.patches.crop_size, self.patches.crop_size))
         steps = 0
         self.net.train()
 
@@ -153,56 +241,87 @@ class Trainer(object):
 
         self.best_psnr = 0
         self.augmentation = False  # disenable data augmentation to warm up the encoder
+        size = None
+        batch_size = self.args.batch_size
         for i in range(self.args.start_iter, self.args.max_iter):
-            self.scheduler.step()
+            # samples of this epoch the sampler skips, non-zero when resuming from a mid-epoch checkpoint
+            offset = self.resume_offset if i == self.args.start_iter else 0
+            if offset == 0:
+                # a mid-epoch checkpoint holds the scheduler of its epoch already
+                self.scheduler.step()
             logging.info('current_lr: %f' % (self.optimizer_G.param_groups[0]['lr']))
+            if self.schedule is not None and self.schedule.size_at(i) != size:
+                # new resolution stage: same pixels per step, more samples per batch
+                size = self.schedule.size_at(i)
+                batch_size = self.schedule.batch_size(self.args.batch_size, size, self.args.world_size if self.args.dist else 1)
+                self.train_dataloader = self.loaders.add('train', self.create_train_dataloader(batch_size, i, offset))
+                if self.args.rank <= 0:
+                    logging.info('progressive training: %dx%d inputs, batch size %d' % (size, size, batch_size))
             t0 = time.time()
-            for j, batch_samples in enumerate(self.train_dataloader):
+            epoch_t0, samples, epoch_samples = t0, 0, 0
+            if hasattr(self.train_dataset, 'set_epoch'):
+                self.train_dataset.set_epoch(i)
+            train_batches = self.train_dataloader
+            if getattr(self.args, 'prefetch', 0) > 0:
+                # the next batches are loaded and copied to the device while this one is trained on
+                train_batches = DevicePrefetcher(self.train_dataloader, self.device, self.args.prefetch)
+            for j, batch_samples in enumerate(train_batches):
                 log_info = 'epoch:%03d step:%04d  ' % (i, j)
 
                 ## prepare data
                 batch_samples = self.prepare(batch_samples)
+                if self.noise is not None:
+                    batch_samples = self.noise(batch_samples)
+                if self.schedule is not None:
+                    batch_samples['images'], batch_samples['labels'] = self.schedule(batch_samples['images'], batch_samples['labels'], size)
+                if self.patches is not None:
+                    batch_samples['images'], batch_samples['labels'] = self.patches(batch_samples['images'], batch_samples['labels'])
+                if self.augmentation:
+                    batch_samples['images'], batch_samples['labels'] = self.augment(batch_samples['images'], batch_samples['labels'])
                 images = batch_samples['images']
                 labels = batch_samples['labels']
+                micro_batches = self.micro.split(self.net, images, labels, self.amp)
+                if self.amp.enabled and i == self.args.start_iter and j == 0 and getattr(self.args, 'amp_bench', 0) > 0:
+                    log_benchmark(self.net, micro_batches[0][0], micro_batches[0][1], self.amp, self.args.amp_bench)
+                samples += images.size(0)
 
-                ## forward
-                output = self.net(images)
-
-                ## optimization
-                loss = 0
+                ## optimization: the gradients of the micro-batches are accumulated, one step per batch
                 self.optimizer_G.zero_grad()
-
-                if self.args.loss_mse:
-                    mse_loss = self.criterion_mse(output,labels)
-                    mse_loss = mse_loss * self.lambda_mse
-                    loss += mse_loss
-                    log_info += 'mse_loss:%.06f ' % (mse_loss.item())
-
-                if self.args.loss_l1: # Default is L1 loss.
-                    l1_loss = self.criterion_l1(output, labels)
-                    l1_loss = l1_loss * self.lambda_l1
-                    loss += l1_loss
-                    log_info += 'l1_loss:%.06f ' % (l1_loss.item())
-
+                outputs = []
+                loss_values = OrderedDict()
+                for k, (micro_images, micro_labels) in enumerate(micro_batches):
+                    # share of the micro-batch in the batch, the accumulated gradient is the one of the whole batch
+                    weight = micro_images.size(0) / float(images.size(0))
+                    with self.micro.no_sync(self.net, k < len(micro_batches) - 1):
+                        with self.amp.autocast():
+                            ## forward
+                            # the losses and the visualization work on the float32 output
+                            output = self.net(micro_images).float()
+                            loss, losses = self.compute_losses(output, micro_labels)
+                        self.amp.backward(loss * weight)
+                    for name, value in losses.items():
+                        loss_values[name] = loss_values.get(name, 0) + value.item() * weight
+                    loss_values['loss_sum'] = loss_values.get('loss_sum', 0) + loss.item() * weight
+                    outputs.append(output.detach())
+                output = outputs[0] if len(outputs) == 1 else torch.cat(outputs)
+                self.amp.step(self.optimizer_G)
                 if self.args.loss_adv:
-                    adv_loss, d_loss = self.criterion_adv(output, labels)
-                    adv_loss = adv_loss * self.lambda_adv
-                    loss += adv_loss
-                    log_info += 'adv_loss:%.06f ' % (adv_loss.item())
-                    log_info += 'd_loss:%.06f ' % (d_loss.item())
-
-                log_info += 'loss_sum:%f ' % (loss.item())
-                loss.backward()
-                self.optimizer_G.step()
+                    # on the detached outputs of the whole batch
+                    loss_values['d_loss'] = self.criterion_adv.update_discriminator(output, labels, self.amp).item()
+                for name, value in loss_values.items():
+                    log_info += ('%s:%f ' if name == 'loss_sum' else '%s:%.06f ') % (name, value)
 
                 ## print information
                 if j % self.args.log_freq == 0:
                     t1 = time.time()
                     log_info += 'aug:%s ' % str(self.augmentation)
-                    log_info += '%4.6fs/batch' % ((t1-t0)/self.args.log_freq)
+                    log_info += '%4.6fs/batch ' % ((t1-t0)/self.args.log_freq)
+                    log_info += '%.1f samples/s' % (samples * (self.args.world_size if self.args.dist else 1) / max(t1 - t0, 1e-9))
                     if self.args.rank <= 0:
                         logging.info(log_info)
                     t0 = time.time()
+                    epoch_samples += samples
+                    samples = 0
 
                 ## Visualization: Call the vis_results function for visualization at regular intervals
                 if j % self.args.vis_freq == 0:
@@ -215,16 +334,34 @@ class Trainer(object):
                     if steps % self.args.vis_step_freq == 0:
                         if self.args.rank <= 0:
                             if self.args.loss_mse:
-                                tb_logger.add_scalar('mse_loss', mse_loss.item(), steps)
+                                tb_logger.add_scalar('mse_loss', loss_values['mse_loss'], steps)
                             if self.args.loss_l1:
-                                tb_logger.add_scalar('l1_loss', l1_loss.item(), steps)
+                                tb_logger.add_scalar('l1_loss', loss_values['l1_loss'], steps)
                             if self.args.loss_adv:
                                 if i > 5:
-                                    tb_logger.add_scalar('adv_loss', adv_loss.item(), steps)
-                                    tb_logger.add_scalar('d_loss', d_loss.item(), steps)
+                                    tb_logger.add_scalar('adv_loss', loss_values['adv_loss'], steps)
+                                    tb_logger.add_scalar('d_loss', loss_values['d_loss'], steps)
 
                 steps += 1
 
+                ## mid-epoch checkpoint, resumed exactly with --resume_sampler
+                if getattr(self.args, 'save_step_freq', 0) > 0 and (j + 1) % self.args.save_step_freq == 0:
+                    if self.args.rank <= 0 and self.train_sampler is not None:
+                        rank_batch_size = batch_size // self.args.world_size if self.args.dist else batch_size
+                        position = min(offset + (j + 1) * rank_batch_size, self.train_sampler.num_samples)
+                        logging.info('Saving state, epoch: %d iter:%d' % (i, j + 1))
+                        self.save_networks('net', 'latest')
+                        self.save_networks('optimizer_G', 'latest')
+                        self.save_networks('scheduler', 'latest')
+                        self.save_sampler('latest', i, position)
+
+            epoch_samples += samples
+            if self.args.rank <= 0:
+                epoch_time = time.time() - epoch_t0
+                logging.info('epoch %d: %d samples in %.1fs, %.1f samples/s (amp %s)' %
+                             (i, epoch_samples, epoch_time, epoch_samples * (self.args.world_size if self.args.dist else 1) / max(epoch_time, 1e-9),
+                              self.amp.mode))
+
             ## save networks
             if i % self.args.save_epoch_freq == 0:
                 if self.args.rank <= 0:
@@ -232,9 +369,13 @@ class Trainer(object):
                     self.save_networks('net', i)
                     self.save_networks('optimizer_G', i)
                     self.save_networks('scheduler', i)
+                    if self.train_sampler is not None:
+                        self.save_sampler(i, i + 1, 0)
 
             if not self.args.loss_adv:
-                if i > 200 and self.args.modal != 'ALL':
+                # with --modal ALL the test set holds all contrasts (TrainSet / TestSet are multi-contrast),
+                # net_best.pth is then the best mean over T1, T2 and FLAIR
+                if i > 200:
                     self.args.phase = 'eval'
                     psnr, ssim,psnr_std,ssim_std = self.evaluate()
                     logging.info('Mean: psnr:%.06f   ssim:%.06f ' % (psnr, ssim))
@@ -253,6 +394,7 @@ class Trainer(object):
                     self.args.phase = 'train'
 
         ## end of training
+        self.loaders.shutdown()
         if self.args.rank <= 0:
             # tb_logger.close()
             self.save_networks('net', 'final')
@@ -289,6 +431,7 @@ class Trainer(object):
                 PSNR.append(psnr)
                 SSIM.append(ssim)
                 logging.info('psnr: %.4f    ssim: %.4f' % (psnr, ssim))
+        self.loaders.shutdown()
         # np.save(f'M4RawV1.0_experiment/predictions/exp_result/finetune-{self.net_name}-{self.args.modal}.npy',predictions)
         psnr_mean = np.mean(PSNR)
         ssim_mean = np.mean(SSIM)
@@ -327,6 +470,13 @@ class Trainer(object):
                 PSNR.append(psnr)
                 SSIM.append(ssim)
 
+        modals = getattr(self.test_dataset, 'modals', [])
+        if len(modals) > 1 and hasattr(self.test_dataset, 'contrast'):
+            # the test loader keeps the sample order, batch k is sample k
+            contrast = self.test_dataset.contrast(np.arange(len(PSNR)))
+            for k, modal in enumerate(modals):
+                logging.info('%s: psnr:%.06f   ssim:%.06f ' % (modal, np.mean(np.array(PSNR)[contrast == k]), np.mean(np.array(SSIM)[contrast == k])))
+
         psnr_mean = np.mean(PSNR)
         ssim_mean = np.mean(SSIM)
         psnr_std = np.std(PSNR)
@@ -356,6 +506,11 @@ class Trainer(object):
             network.load_state_dict(load_net_clean, strict=strict)
         del load_net_clean
 
+    def save_sampler(self, name, epoch, offset):
+        """Saves the sampler position: the next sample is sample offset of epoch."""
+        save_path = os.path.join(self.args.snapshot_save_dir, 'train_sampler_{}.pth'.format(name))
+        torch.save({'epoch': epoch, 'offset': offset}, save_path)
+
     def save_networks(self, net_name, epoch):
         network = getattr(self, net_name)
         save_filename = '{}_{}.pth'.format(net_name, epoch)
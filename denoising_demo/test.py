@@ -35,6 +35,23 @@ def main():
     parser.add_argument('--batch_size', default=8, type=int)
     parser.add_argument('--num_workers', default=4, type=int)
     parser.add_argument('--data_augmentation', default=False, type=bool)
+    parser.add_argument('--cache_dir', default='', type=str, help='folder of the persistent RSS cache, empty to disable')
+    parser.add_argument('--max_open_files', default=64, type=int, help='open H5 handles kept per process by LazyTrainSet/LazyTestSet')
+    parser.add_argument('--h5_cache_mb', default=4, type=float, help='HDF5 chunk cache per dataset of the handles of LazyTrainSet/LazyTestSet')
+    parser.add_argument('--preprocess_workers', default=0, type=int, help='processes running read_h5 while building TrainSet/TestSet, 0 for serial')
+    parser.add_argument('--storage_dtype', default='float32', type=str, help='float32 | float16 | uint16, precision of the in-memory TrainSet/TestSet arrays')
+    parser.add_argument('--shared_dataset', action='store_true', help='build TrainSet/TestSet once per node and map it read-only in every rank and worker')
+    parser.add_argument('--shared_dir', default='/dev/shm', type=str)
+    parser.add_argument('--rss_source', default='kspace', type=str, help='kspace | auto, auto reads the stored reconstruction_rss when it is valid')
+    parser.add_argument('--recon_memory', default=1024, type=int, help='MB of working memory per k-space reconstruction chunk')
+    parser.add_argument('--recon_threads', default=0, type=int, help='torch threads of the k-space reconstruction, 0 keeps the default')
+    parser.add_argument('--recon_device', default='cpu', type=str, help='device of the k-space reconstruction, e.g. cpu | cuda:0')
+    parser.add_argument('--virtual_coils', default=0, type=int, help='SVD coil compression of every volume to this many virtual coils, 0 disables it')
+    parser.add_argument('--coil_energy', default=0., type=float, help='with --virtual_coils 0: fewest virtual coils keeping this energy fraction, e.g. 0.99')
+    parser.add_argument('--fastmri_root', default='/data2/fastmri/png', type=str, help='FastMRI PNG tree with train/ and val/ folders')
+    parser.add_argument('--manifest', default='', type=str, help='FastMRI manifest file, built on the first run and reused afterwards')
+    parser.add_argument('--refresh_manifest', action='store_true', help='relist the FastMRI patient folders that changed since the manifest was built')
+    parser.add_argument('--packed_dir', default='./fastmri_packed', type=str, help='uint8 slices of PackedFastMRITrainSet / PackedFastMRITestSet')
     
     parser.add_argument('--resume', default='./pretrained_weights/masa_rec.pth', type=str)
     parser.add_argument('--testset', default='TestSet', type=str, help='Sun80 | Urban100 | TestSet_multi')
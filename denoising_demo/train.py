@@ -52,12 +52,44 @@ def main():
     parser.add_argument('--testdata_root', default='/data0/M4RawV1.5/multicoil_val/',type=str)
     parser.add_argument('--dataset', default='M4Raw', type=str, help='M4Raw | fastMRI | DlDegibbs | ARMNet')
     parser.add_argument('--modal', default='T1', type=str, help='T1 | T2 | FLAIR | ALL')
-    parser.add_argument('--trainset', default='TrainSet', type=str, help='TrainSet | FastMRITrainSet')
-    parser.add_argument('--testset', default='TestSet', type=str, help='TestSet | FastMRITestSet')
+    parser.add_argument('--trainset', default='TrainSet', type=str, help='TrainSet | LazyTrainSet | StreamTrainSet | FastMRITrainSet')
+    parser.add_argument('--testset', default='TestSet', type=str, help='TestSet | LazyTestSet | FastMRITestSet')
     parser.add_argument('--save_test_root', default='generated', type=str)
     parser.add_argument('--batch_size', default=9*4, type=int)
     parser.add_argument('--num_workers', default=9, type=int)
     parser.add_argument('--data_augmentation', action='store_true')
+    parser.add_argument('--prefetch', default=2, type=int, help='training batches staged on the device by a background thread, 0 to disable')
+    parser.add_argument('--crop_size', default=0, type=int, help='patch training: side of the random crops fed to the network, 0 trains on full slices')
+    parser.add_argument('--patches_per_slice', default=1, type=int, help='patch training: crops cut out of every loaded slice')
+    parser.add_argument('--progressive', default='', type=str, help='progressive resolution, epoch:size stages, e.g. 0:64,40:128,100:256')
+    parser.add_argument('--progressive_mode', default='resize', type=str, help='resize | crop, how the smaller inputs of --progressive are made')
+    parser.add_argument('--aug_crop', default=0, type=int, help='side of the random augmentation crops, 0 keeps the full slices')
+    parser.add_argument('--aug_scale', default=0.1, type=float, help='intensity scale of the augmentation drawn from [1 - aug_scale, 1 + aug_scale]')
+    parser.add_argument('--cache_dir', default='', type=str, help='folder of the persistent RSS cache, empty to disable')
+    parser.add_argument('--max_open_files', default=64, type=int, help='open H5 handles kept per process by LazyTrainSet/LazyTestSet')
+    parser.add_argument('--h5_cache_mb', default=4, type=float, help='HDF5 chunk cache per dataset of the handles of LazyTrainSet/LazyTestSet')
+    parser.add_argument('--preprocess_workers', default=0, type=int, help='processes running read_h5 while building TrainSet/TestSet, 0 for serial')
+    parser.add_argument('--storage_dtype', default='float32', type=str, help='float32 | float16 | uint16, precision of the in-memory TrainSet/TestSet arrays')
+    parser.add_argument('--shared_dataset', action='store_true', help='build TrainSet/TestSet once per node and map it read-only in every rank and worker')
+    parser.add_argument('--shared_dir', default='/dev/shm', type=str)
+    parser.add_argument('--rss_source', default='kspace', type=str, help='kspace | auto, auto reads the stored reconstruction_rss when it is valid')
+    parser.add_argument('--recon_memory', default=1024, type=int, help='MB of working memory per k-space reconstruction chunk')
+    parser.add_argument('--recon_threads', default=0, type=int, help='torch threads of the k-space reconstruction, 0 keeps the default')
+    parser.add_argument('--recon_device', default='cpu', type=str, help='device of the k-space reconstruction, e.g. cpu | cuda:0')
+    parser.add_argument('--virtual_coils', default=0, type=int, help='SVD coil compression of every volume to this many virtual coils, 0 disables it')
+    parser.add_argument('--coil_energy', default=0., type=float, help='with --virtual_coils 0: fewest virtual coils keeping this energy fraction, e.g. 0.99')
+    parser.add_argument('--fastmri_root', default='/data2/fastmri/png', type=str, help='FastMRI PNG tree with train/ and val/ folders')
+    parser.add_argument('--manifest', default='', type=str, help='FastMRI manifest file, built on the first run and reused afterwards')
+    parser.add_argument('--refresh_manifest', action='store_true', help='relist the FastMRI patient folders that changed since the manifest was built')
+    parser.add_argument('--packed_dir', default='./fastmri_packed', type=str, help='uint8 slices of PackedFastMRITrainSet / PackedFastMRITestSet')
+    parser.add_argument('--device_noise', default='', type=str, help='gaussian | rician | kspace, FastMRI training noise added per batch on the device, empty for per-sample noise in the workers')
+    parser.add_argument('--num_coils', default=4, type=int, help='coils of the kspace noise simulator')
+    parser.add_argument('--coil_correlation', default=0., type=float, help='noise correlation of every coil pair of the kspace noise simulator')
+    parser.add_argument('--coil_covariance', default='', type=str, help='.npy [num_coils][num_coils] coil noise covariance, overrides --coil_correlation')
+    parser.add_argument('--train_shards', default='', type=str, help='comma separated globs of the H5 shards read by StreamTrainSet')
+    parser.add_argument('--shuffle_buffer', default=2048, type=int, help='samples held by the StreamTrainSet shuffle buffer')
+    parser.add_argument('--stream_chunk', default=32, type=int, help='consecutive slices read at once by StreamTrainSet')
+    parser.add_argument('--stream_prefetch', default=4, type=int, help='chunks read ahead by the StreamTrainSet background thread')
     
     ## optim setting
     parser.add_argument('--lr', default=1e-4, type=float)
@@ -65,6 +97,10 @@ def main():
     parser.add_argument('--weight_decay', default=0, type=float)
     parser.add_argument('--start_iter', default=0, type=int)
     parser.add_argument('--max_iter', default=500, type=int)
+    parser.add_argument('--amp', default='off', type=str, choices=['off', 'fp16', 'bf16'], help='mixed-precision training, bf16 also runs on the CPU')
+    parser.add_argument('--amp_bench', default=0, type=int, help='with --amp: time this many float32 and mixed-precision steps before training and log the speedup')
+    parser.add_argument('--accum_steps', default=1, type=int, help='micro-batches per training batch, their gradients are accumulated into one optimizer step')
+    parser.add_argument('--micro_memory', default=0, type=float, help='MB of activations per micro-batch, picks the largest fitting micro-batch instead of --accum_steps, 0 to disable')
 
     parser.add_argument('--loss_l1', action='store_true')
     parser.add_argument('--loss_mse', action='store_true')
@@ -79,11 +115,13 @@ def main():
     parser.add_argument('--resume', default='', type=str)
     parser.add_argument('--resume_optim', default='', type=str)
     parser.add_argument('--resume_scheduler', default='', type=str)
+    parser.add_argument('--resume_sampler', default='', type=str, help='train_sampler_*.pth, continues at the saved epoch and sample')
 
     ## log setting
     parser.add_argument('--log_freq', default=10, type=int)
     parser.add_argument('--vis_freq', default=50000, type=int)     
     parser.add_argument('--save_epoch_freq', default=10, type=int) 
+    parser.add_argument('--save_step_freq', default=0, type=int, help='mid-epoch checkpoints (*_latest.pth) every n steps, 0 to disable')
     parser.add_argument('--test_freq', default=100, type=int)      
     parser.add_argument('--save_folder', default='./UpBlockForUNetWithResNet50_experiment', type=str)
     parser.add_argument('--vis_step_freq', default=100, type=int)
@@ -17,6 +17,10 @@ from fastmri.data.subsample import create_mask_for_mask_type
 from fastmri.data.transforms import VarNetDataTransform
 from fastmri.pl_modules import FastMriDataModule, VarNetModule
 
+# coil compression of the denoising demo (dataloader/coil_compression.py)
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[2] / "denoising_demo"))
+from dataloader.coil_compression import CoilCompressedTransform  # noqa: E402
+
 
 def cli_main(args):
     pl.seed_everything(args.seed)
@@ -29,9 +33,16 @@ def cli_main(args):
         args.mask_type, args.center_fractions, args.accelerations
     )
     # use random masks for train transform, fixed masks for val transform
-    train_transform = VarNetDataTransform(mask_func=mask, use_seed=False)
-    val_transform = VarNetDataTransform(mask_func=mask)
-    test_transform = VarNetDataTransform()
+    # the k-space of every slice is coil-compressed first with --virtual_coils / --coil_energy
+    train_transform = CoilCompressedTransform(
+        VarNetDataTransform(mask_func=mask, use_seed=False), args.virtual_coils, args.coil_energy
+    )
+    val_transform = CoilCompressedTransform(
+        VarNetDataTransform(mask_func=mask), args.virtual_coils, args.coil_energy
+    )
+    test_transform = CoilCompressedTransform(
+        VarNetDataTransform(), args.virtual_coils, args.coil_energy
+    )
     # ptl data module - this handles data loaders
     data_module = FastMriDataModule(
         data_path=args.data_path,
@@ -124,6 +135,19 @@ def build_args():
         help="Acceleration rates to use for masks",
     )
 
+    parser.add_argument(
+        "--virtual_coils",
+        default=0,
+        type=int,
+        help="SVD coil compression to this many virtual coils, 0 disables it",
+    )
+    parser.add_argument(
+        "--coil_energy",
+        default=0.0,
+        type=float,
+        help="With --virtual_coils 0: fewest virtual coils keeping this energy fraction",
+    )
+
     # data config
     parser = FastMriDataModule.add_data_specific_args(parser)
     parser.set_defaults(